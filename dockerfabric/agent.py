@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from fabric.api import env, settings
+from fabric.thread_handling import ThreadHandler
+import six
+
+from .socat import socat_tunnels
+from .streamlocal import streamlocal_tunnels
+from .tunnel import channel_schedulers, local_tunnels
+
+log = logging.getLogger(__name__)
+
+DEFAULT_AGENT_SOCKET = '~/.docker-fabric/agent.sock'
+CMD_CONNECT = 'connect'
+CMD_STATUS = 'status'
+CMD_STOP = 'stop'
+
+
+class AgentError(Exception):
+    pass
+
+
+def get_agent_socket():
+    """
+    Returns the path of the agent's control socket, as set in ``env.docker_agent_socket``.
+
+    :return: Path to the Unix socket.
+    :rtype: unicode
+    """
+    return os.path.expanduser(env.get('docker_agent_socket') or DEFAULT_AGENT_SOCKET)
+
+
+def agent_request(command, socket_path=None, timeout=None, **kwargs):
+    """
+    Sends a request to a running :class:`TunnelAgent` and returns its response.
+
+    :param command: Command for the agent: ``connect``, ``status``, or ``stop``.
+    :type command: unicode
+    :param socket_path: Path to the agent's control socket. By default uses :func:`get_agent_socket`.
+    :type socket_path: unicode
+    :param timeout: Timeout in seconds; by default uses ``env.docker_agent_timeout`` or 60 seconds.
+    :type timeout: float
+    :param kwargs: Further arguments of the command.
+    :return: Response of the agent.
+    :rtype: dict
+    :raise AgentError: If the agent could not process the request.
+    :raise socket.error: If the agent cannot be reached.
+    """
+    request = dict(kwargs, command=command)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout or float(env.get('docker_agent_timeout') or 60))
+        sock.connect(socket_path or get_agent_socket())
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not line:
+        raise AgentError("No response from agent.")
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        raise AgentError(response['error'])
+    return response
+
+
+def get_agent_url(base_url, remote_port, local_port):
+    """
+    Requests a tunnel to the Docker service of the current host from a running :class:`TunnelAgent`. If no agent is
+    running, or it cannot provide a tunnel, returns ``None``, so that the caller can open its own tunnel instead.
+
+    The agent is used if its control socket exists, unless ``env.docker_agent`` is set to ``False``.
+
+    :param base_url: URL of the Docker service on the remote host.
+    :type base_url: unicode
+    :param remote_port: Remote port of the Docker service.
+    :type remote_port: int
+    :param local_port: Local port for the tunnel.
+    :type local_port: int
+    :return: URL of the tunnel provided by the agent, or ``None``.
+    :rtype: unicode
+    """
+    if not (env.get('docker_agent', True) and env.host_string and hasattr(socket, 'AF_UNIX')):
+        return None
+    socket_path = get_agent_socket()
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        response = agent_request(CMD_CONNECT, socket_path, host_string=env.host_string, base_url=base_url,
+                                 remote_port=remote_port, local_port=local_port)
+    except (socket.error, ValueError, AgentError) as e:
+        log.warning("Tunnel agent at %s not available (%s); connecting directly.", socket_path, e)
+        return None
+    log.debug("Using tunnel %s from agent for host %s.", response['url'], env.host_string)
+    return response['url']
+
+
+class TunnelAgent(object):
+    """
+    Keeps SSH connections and tunnels to Docker services open across multiple Fabric runs, similar to an SSH
+    ControlMaster. Clients request a tunnel for a host through a Unix socket, and connect to the tunnel's local port or
+    socket. Tunnels are opened with the ``env`` settings of the process running the agent, i.e. the agent has to be
+    able to authenticate without prompts.
+
+    :param connect_tunnel: Callable that opens a tunnel on ``env.host_string`` and returns its URL, with the arguments
+      base URL, remote port, and local port.
+    :type connect_tunnel: callable
+    :param socket_path: Path to the control socket. By default uses :func:`get_agent_socket`.
+    :type socket_path: unicode
+    :param idle_timeout: Time in seconds without requests, after which the agent terminates. By default uses
+      ``env.docker_agent_idle_timeout``; ``0`` or ``None`` keeps running until stopped.
+    :type idle_timeout: float
+    """
+    def __init__(self, connect_tunnel, socket_path=None, idle_timeout=None):
+        self.connect_tunnel = connect_tunnel
+        self.socket_path = socket_path or get_agent_socket()
+        self.idle_timeout = float(idle_timeout or env.get('docker_agent_idle_timeout') or 0)
+        self.last_request = time.time()
+        self.listening_socket = None
+        # Fabric's env is global; tunnels are therefore set up one at a time.
+        self._connect_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def bind(self):
+        """
+        Creates the control socket. Only the current user has access to it. A stale socket of an agent that is no
+        longer running is replaced.
+
+        :raise AgentError: If another agent is already listening on the socket.
+        """
+        socket_dir = os.path.dirname(self.socket_path)
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, 0o700)
+        if os.path.exists(self.socket_path):
+            try:
+                agent_request(CMD_STATUS, self.socket_path, timeout=5)
+            except (socket.error, ValueError, AgentError):
+                os.unlink(self.socket_path)
+            else:
+                raise AgentError("An agent is already running on {0}.".format(self.socket_path))
+        listening_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            listening_socket.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        listening_socket.listen(socket.SOMAXCONN)
+        self.listening_socket = listening_socket
+
+    def _connect(self, request):
+        with self._connect_lock:
+            with settings(host_string=request['host_string'], abort_on_prompts=True):
+                return {'url': self.connect_tunnel(request.get('base_url'), request.get('remote_port'),
+                                                   request.get('local_port'))}
+
+    def _status(self):
+        tunnels = []
+        for tunnel_dict in (local_tunnels, socat_tunnels, streamlocal_tunnels):
+            for key, tunnel in list(six.iteritems(tunnel_dict)):
+                tunnels.append('{0}: {1}'.format(':'.join(map(six.text_type, key)), tunnel.statistics))
+        for host_string, scheduler in list(six.iteritems(channel_schedulers)):
+            tunnels.append('{0}: {1}'.format(host_string, scheduler))
+        return {'tunnels': tunnels}
+
+    def _handle(self, conn):
+        try:
+            line = conn.makefile('rb').readline()
+            request = json.loads(line.decode('utf-8'))
+            command = request.get('command')
+            if command == CMD_CONNECT:
+                response = self._connect(request)
+            elif command == CMD_STATUS:
+                response = self._status()
+            elif command == CMD_STOP:
+                self._stopped.set()
+                response = {'stopped': True}
+            else:
+                response = {'error': "Invalid command: {0}".format(command)}
+        except (Exception, SystemExit) as e:
+            # Fabric aborts with SystemExit, e.g. if authentication would require a prompt.
+            log.exception("Failed to process agent request.")
+            response = {'error': six.text_type(e) or e.__class__.__name__}
+        try:
+            conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def serve(self):
+        """
+        Processes requests until the agent is stopped or has been idle for longer than :attr:`idle_timeout`. Binds the
+        control socket, if :meth:`bind` has not been called before. On exit, closes all tunnels.
+        """
+        if self.listening_socket is None:
+            self.bind()
+        log.info("Tunnel agent listening on %s.", self.socket_path)
+        try:
+            while not self._stopped.is_set():
+                if self.idle_timeout and time.time() - self.last_request > self.idle_timeout:
+                    log.info("Tunnel agent has been idle for %s seconds; stopping.", self.idle_timeout)
+                    break
+                try:
+                    r, w, x = select.select([self.listening_socket], [], [], 1)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if r:
+                    conn, __ = self.listening_socket.accept()
+                    self.last_request = time.time()
+                    ThreadHandler('agent_request', self._handle, conn)
+        finally:
+            self.close()
+
+    def start_daemon(self):
+        """
+        Binds the control socket and runs :meth:`serve` in a detached child process. Only available on POSIX systems.
+
+        :return: Process id of the agent.
+        :rtype: int
+        """
+        self.bind()
+        pid = os.fork()
+        if pid:
+            # The socket file belongs to the child process now.
+            self.listening_socket.close()
+            self.listening_socket = None
+            return pid
+        try:
+            os.setsid()
+            null_fd = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null_fd, fd)
+            self.serve()
+        finally:
+            os._exit(0)
+
+    def stop(self):
+        """
+        Stops processing requests. :meth:`serve` returns within a second.
+        """
+        self._stopped.set()
+
+    def close(self):
+        """
+        Removes the control socket and closes all tunnels and additional SSH connections.
+        """
+        if self.listening_socket is not None:
+            self.listening_socket.close()
+            self.listening_socket = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        for connection_dict in (local_tunnels, socat_tunnels, streamlocal_tunnels, channel_schedulers):
+            connection_dict.close_all()
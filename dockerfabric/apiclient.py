@@ -1,19 +1,32 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from contextlib import contextmanager
+import logging
+from multiprocessing.pool import ThreadPool
+
 from fabric.api import env, sudo
 from fabric.utils import puts, fastprint, error
 
+from docker.errors import NotFound
 from dockermap.client.base import LOG_PROGRESS_FORMAT, DockerStatusError
 from dockermap.api import DockerClientWrapper
+from .agent import get_agent_url
 from .base import (get_local_port, set_raise_on_error, DockerConnectionDict, FabricClientConfiguration,
-                   FabricContainerClient)
+                   FabricContainerClient, InspectPrefetchMixin)
 from .socat import socat_tunnels
+from .streamlocal import streamlocal_tunnels
 from .tunnel import local_tunnels
+from .utils.progress import get_progress_renderer
+from .utils.streams import iter_tar_stream
+
 
+log = logging.getLogger(__name__)
 
 DEFAULT_TCP_HOST = 'tcp://127.0.0.1'
+DEFAULT_UNIX_PREFIX = 'http+unix://'
 DEFAULT_SOCKET = '/var/run/docker.sock'
+DEFAULT_INSPECT_POOL_SIZE = 10
 progress_fmt = LOG_PROGRESS_FORMAT.format
 
 
@@ -24,20 +37,32 @@ def _get_port_number(expr, port_loc):
         raise ValueError("Missing or invalid {0} port ({1}).".format(port_loc, expr))
 
 
-def _get_socat_tunnel(address, local_port):
-    init_local_port = _get_port_number(local_port, 'local')
+def _get_tunnel_url(tunnel):
+    if tunnel.bind_socket:
+        return ''.join((DEFAULT_UNIX_PREFIX, tunnel.bind_socket))
+    return '{0}:{1}'.format(DEFAULT_TCP_HOST, tunnel.bind_port)
+
+
+def _get_socket_tunnel(address, local_port):
+    init_local_port = _get_port_number(local_port, 'local') if local_port is not None else 0
     tunnel_local_port = get_local_port(init_local_port)
-    socat_tunnel = socat_tunnels[(address, tunnel_local_port)]
-    return '{0}:{1}'.format(DEFAULT_TCP_HOST, socat_tunnel.bind_port), socat_tunnel
+    if env.get('docker_tunnel_streamlocal', True):
+        socket_tunnel = streamlocal_tunnels[(address, tunnel_local_port)]
+    else:
+        socket_tunnel = socat_tunnels[(address, tunnel_local_port)]
+    return _get_tunnel_url(socket_tunnel), socket_tunnel
 
 
 def _get_local_tunnel(address, remote_port, local_port):
     host_port = address.partition('/')[0]
     host, __, port = host_port.partition(':')
     service_remote_port = _get_port_number(port or remote_port, 'remote')
-    init_local_port = _get_port_number(local_port or port or remote_port, 'local')
+    if local_port is not None and _get_port_number(local_port, 'local') == 0:
+        init_local_port = 0
+    else:
+        init_local_port = _get_port_number(local_port or port or remote_port, 'local')
     local_tunnel = local_tunnels[(host, service_remote_port, 'localhost', init_local_port)]
-    return '{0}:{1}'.format(DEFAULT_TCP_HOST, local_tunnel.bind_port), local_tunnel
+    return _get_tunnel_url(local_tunnel), local_tunnel
 
 
 def _get_connection_args(base_url, remote_port, local_port):
@@ -52,16 +77,39 @@ def _get_connection_args(base_url, remote_port, local_port):
                         address = address[1:]
                     elif address[0] != '/':
                         address = ''.join(('/', address))
-                    return _get_socat_tunnel(address, local_port)
+                    return _get_socket_tunnel(address, local_port)
                 return _get_local_tunnel(address.lstrip('/'), remote_port, local_port)
             elif base_url[0] == '/':
-                return _get_socat_tunnel(base_url, local_port)
+                return _get_socket_tunnel(base_url, local_port)
             return _get_local_tunnel(base_url, remote_port, local_port)
-        return _get_socat_tunnel(DEFAULT_SOCKET, local_port)
+        return _get_socket_tunnel(DEFAULT_SOCKET, local_port)
     return base_url, None
 
 
-class DockerFabricClient(DockerClientWrapper):
+def get_tunnel_url(base_url=None, remote_port=None, local_port=None):
+    """
+    Opens a tunnel to the Docker service on the current host, or re-uses an existing one, and returns the URL for
+    connecting to it. Used by :class:`~dockerfabric.agent.TunnelAgent`.
+
+    :param base_url: URL of the Docker service on the remote host; if not set, will use ``env.docker_base_url``.
+    :type base_url: unicode
+    :param remote_port: Remote port of the Docker service; if not set, will use ``env.docker_tunnel_remote_port``.
+    :type remote_port: int
+    :param local_port: Local port for the tunnel; if not set, will use ``env.docker_tunnel_local_port``.
+    :type local_port: int
+    :return: URL of the tunnel.
+    :rtype: unicode
+    """
+    url = base_url or env.get('docker_base_url')
+    tunnel_remote_port = remote_port or env.get('docker_tunnel_remote_port')
+    if local_port is None:
+        tunnel_local_port = env.get('docker_tunnel_local_port', tunnel_remote_port)
+    else:
+        tunnel_local_port = local_port
+    return _get_connection_args(url, tunnel_remote_port, tunnel_local_port)[0]
+
+
+class DockerFabricClient(InspectPrefetchMixin, DockerClientWrapper):
     """
     Docker client for Fabric.
 
@@ -69,7 +117,11 @@ class DockerFabricClient(DockerClientWrapper):
     :class:`~dockermap.client.base.DockerClientWrapper`. This implementation only adds the possibility to build a
     tunnel through the current SSH connection and adds Fabric-usual logging.
 
-    If a unix socket is used, `socat` will be started on the remote side to redirect it to a TCP port.
+    If a unix socket is used, channels are opened directly to the socket if the SSH server supports this. Otherwise,
+    `socat` will be started on the remote side to redirect it to a TCP port.
+
+    If a :class:`~dockerfabric.agent.TunnelAgent` is running, the client connects through the agent's tunnel instead of
+    opening its own.
 
     :param base_url: URL to connect to; if not set, will refer to ``env.docker_base_url`` or use ``None``, which by
      default attempts a connection on a Unix socket at ``/var/run/docker.sock``.
@@ -87,7 +139,8 @@ class DockerFabricClient(DockerClientWrapper):
     :type tunnel_remote_port: int
     :param tunnel_local_port: Optional, for SSH tunneling: Port to open towards the local end for the tunnel; if not
      provided, will try to use ``env.docker_tunnel_local_port``; otherwise defaults to the value of
-     ``tunnel_remote_port`` or ``None`` for direct connections without an SSH tunnel.
+     ``tunnel_remote_port`` or ``None`` for direct connections without an SSH tunnel. Setting this to ``0`` uses an
+     ephemeral port assigned by the operating system, which is also the default for socket connections.
     :type tunnel_local_port: int
     :param kwargs: Additional kwargs for :class:`docker.client.Client`
     """
@@ -98,8 +151,17 @@ class DockerFabricClient(DockerClientWrapper):
         api_version = version or env.get('docker_api_version')
         client_timeout = timeout or env.get('docker_timeout')
         remote_port = tunnel_remote_port or env.get('docker_tunnel_remote_port')
-        local_port = tunnel_local_port or env.get('docker_tunnel_local_port', remote_port)
-        conn_url, self._tunnel = _get_connection_args(url, remote_port, local_port)
+        if tunnel_local_port is None:
+            local_port = env.get('docker_tunnel_local_port', remote_port)
+        else:
+            local_port = tunnel_local_port
+        agent_url = get_agent_url(url, remote_port, local_port)
+        if agent_url:
+            conn_url, self._tunnel = agent_url, None
+        else:
+            conn_url, self._tunnel = _get_connection_args(url, remote_port, local_port)
+        self._progress = None
+        self._init_prefetch()
         super(DockerFabricClient, self).__init__(base_url=conn_url, version=api_version, timeout=client_timeout,
                                                  tls=use_tls, **kwargs)
 
@@ -116,14 +178,27 @@ class DockerFabricClient(DockerClientWrapper):
             msg = info % args
         else:
             msg = info
+        if self._progress is not None:
+            self._progress.interrupt()
         try:
             puts('docker: {0}'.format(msg))
         except UnicodeDecodeError:
             puts('docker: -- non-printable output --')
 
+    @contextmanager
+    def _rendered_progress(self):
+        self._progress = get_progress_renderer()
+        try:
+            yield
+        finally:
+            progress, self._progress = self._progress, None
+            progress.finish()
+
     def push_progress(self, status, object_id, progress):
         """
-        Prints progress information.
+        Prints progress information. During pulls and pushes, updates are passed to the renderer set in
+        ``env.docker_progress_renderer`` (see :func:`~dockerfabric.utils.progress.get_progress_renderer`). Otherwise,
+        every update is printed on a new line.
 
         :param status: Status text.
         :type status: unicode
@@ -132,7 +207,10 @@ class DockerFabricClient(DockerClientWrapper):
         :param progress: Progress bar.
         :type progress: unicode
         """
-        fastprint(progress_fmt(status, object_id, progress), end='\n')
+        if self._progress is not None:
+            self._progress.update(status, object_id, progress)
+        else:
+            fastprint(progress_fmt(status, object_id, progress), end='\n')
 
     def close(self):
         """
@@ -187,6 +265,43 @@ class DockerFabricClient(DockerClientWrapper):
         set_raise_on_error(kwargs, False)
         return super(DockerFabricClient, self).cleanup_images(remove_old=remove_old, keep_tags=keep_tags, **kwargs)
 
+    def _inspect_many(self, item_type, keys):
+        """
+        Inspects objects in multiple threads, which share the connection pool of the client. The number of threads is
+        set in ``env.docker_inspect_pool_size`` (default 10). Errors other than that an object does not exist are
+        logged, and do not affect the other objects.
+        """
+        inspect = getattr(super(DockerFabricClient, self), 'inspect_{0}'.format(item_type))
+
+        def _inspect(key):
+            try:
+                return key, inspect(key)
+            except NotFound:
+                return key, None
+            except Exception as e:
+                log.warning("Failed to inspect %s %s: %s", item_type, key, e)
+                return key, e
+
+        pool_size = min(len(keys), int(env.get('docker_inspect_pool_size') or DEFAULT_INSPECT_POOL_SIZE))
+        pool = ThreadPool(pool_size)
+        try:
+            results = pool.map(_inspect, keys, 1)
+        finally:
+            pool.terminate()
+        details = {key: detail for key, detail in results if isinstance(detail, dict)}
+        failed = [key for key, detail in results if isinstance(detail, Exception)]
+        return details, failed
+
+    def inspect_container(self, container):
+        return (self._get_prefetched('container', container) or
+                super(DockerFabricClient, self).inspect_container(container))
+
+    def inspect_network(self, net_id):
+        return self._get_prefetched('network', net_id) or super(DockerFabricClient, self).inspect_network(net_id)
+
+    def inspect_volume(self, name):
+        return self._get_prefetched('volume', name) or super(DockerFabricClient, self).inspect_volume(name)
+
     def import_image(self, image=None, tag='latest', **kwargs):
         """
         Identical to :meth:`docker.api.image.ImageApiMixin.import_image` with additional logging.
@@ -194,6 +309,19 @@ class DockerFabricClient(DockerClientWrapper):
         self.push_log("Fetching image '{0}' from registry.".format(image))
         return super(DockerFabricClient, self).import_image(image=image, tag=tag, **kwargs)
 
+    def load_image(self, data, timeout=None):
+        """
+        Uploads an image, like :meth:`docker.api.image.ImageApiMixin.load_image`, with additional logging. The data can
+        also be a generator, which is sent in chunks as it is produced.
+
+        :param data: Uncompressed or gzip-compressed tarball of the image, as file or iterable of byte strings.
+        :param timeout: Timeout in seconds for this request. If not set, uses the timeout of the client.
+        :type timeout: float
+        """
+        self.push_log("Loading image.")
+        res = self._post(self._url('/images/load'), data=data, timeout=timeout or self.timeout)
+        self._raise_for_status(res)
+
     def login(self, **kwargs):
         """
         Identical to :meth:`dockermap.client.base.DockerClientWrapper.login` with two enhancements:
@@ -224,15 +352,16 @@ class DockerFabricClient(DockerClientWrapper):
         """
         Identical to :meth:`dockermap.client.base.DockerClientWrapper.pull` with two enhancements:
 
-        * additional logging;
+        * additional logging, with progress shown as configured in ``env.docker_progress_renderer``;
         * the ``insecure_registry`` flag can be passed through ``kwargs``, or set as default using
           ``env.docker_registry_insecure``.
         """
         c_insecure = kwargs.pop('insecure_registry', env.get('docker_registry_insecure'))
         set_raise_on_error(kwargs)
         try:
-            return super(DockerFabricClient, self).pull(repository, tag=tag, stream=stream,
-                                                        insecure_registry=c_insecure, **kwargs)
+            with self._rendered_progress():
+                return super(DockerFabricClient, self).pull(repository, tag=tag, stream=stream,
+                                                            insecure_registry=c_insecure, **kwargs)
         except DockerStatusError as e:
             error(e.message)
 
@@ -240,18 +369,40 @@ class DockerFabricClient(DockerClientWrapper):
         """
         Identical to :meth:`dockermap.client.base.DockerClientWrapper.push` with two enhancements:
 
-        * additional logging;
+        * additional logging, with progress shown as configured in ``env.docker_progress_renderer``;
         * the ``insecure_registry`` flag can be passed through ``kwargs``, or set as default using
           ``env.docker_registry_insecure``.
         """
         c_insecure = kwargs.pop('insecure_registry', env.get('docker_registry_insecure'))
         set_raise_on_error(kwargs)
         try:
-            return super(DockerFabricClient, self).push(repository, stream=stream, insecure_registry=c_insecure,
-                                                        **kwargs)
+            with self._rendered_progress():
+                return super(DockerFabricClient, self).push(repository, stream=stream,
+                                                            insecure_registry=c_insecure, **kwargs)
         except DockerStatusError as e:
             error(e.message)
 
+    def put_resource(self, container, local_path, container_path, apply_chown=None, apply_chmod=None):
+        """
+        Uploads a local file or directory into a container, through
+        :meth:`docker.api.container.ContainerApiMixin.put_archive`. The archive is generated while it is sent, using
+        :func:`~dockerfabric.utils.streams.iter_tar_stream`.
+
+        :param container: Container name or id.
+        :type container: unicode
+        :param local_path: Local file or directory. Contents of a directory are placed in ``container_path``.
+        :type local_path: unicode
+        :param container_path: Existing directory in the container.
+        :type container_path: unicode
+        :param apply_chown: Owner to set for the uploaded files, as numeric user and group ids.
+        :type apply_chown: unicode | int | tuple
+        :param apply_chmod: Permissions to set for the uploaded files, in octal notation; directories also get execute
+          permissions where they are readable.
+        :type apply_chmod: unicode | int
+        """
+        self.push_log("Uploading '{0}' to '{1}:{2}'.".format(local_path, container, container_path))
+        return self.put_archive(container, container_path, iter_tar_stream(local_path, apply_chown, apply_chmod))
+
     def restart(self, container, **kwargs):
         """
         Identical to :meth:`docker.api.container.ContainerApiMixin.restart` with additional logging.
@@ -346,8 +497,24 @@ class DockerClientConfiguration(FabricClientConfiguration):
 
 
 class DockerFabricApiConnections(DockerConnectionDict):
+    """
+    Cache for Docker API clients. Clients are replaced if their tunnel has been closed, or if they do not respond to a
+    ping request after being unused for more than ``env.docker_connection_check_interval`` seconds (default 30).
+    """
     configuration_class = DockerClientConfiguration
 
+    def check_client(self, client, idle_time):
+        tunnel = client._tunnel
+        if tunnel is not None and not tunnel.is_alive():
+            return False
+        if idle_time >= env.get('docker_connection_check_interval', 30):
+            try:
+                client.ping()
+            except Exception as e:
+                log.info("Docker service did not respond to ping: %s", e)
+                return False
+        return True
+
 
 class ContainerApiFabricClient(FabricContainerClient):
     configuration_class = DockerClientConfiguration
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from contextlib import contextmanager
 import ctypes
 import logging
 import multiprocessing
+import threading
+import time
 
+from docker.errors import NotFound
+import requests
 from dockermap.api import MappingDockerClient, ClientConfiguration
 from fabric.api import env, settings
+import six
 
 log = logging.getLogger(__name__)
 port_offset = multiprocessing.Value(ctypes.c_ulong)
@@ -25,14 +31,140 @@ def _get_default_config(client_configs):
 
 
 class ConnectionDict(dict):
+    """
+    Cache for connections, e.g. tunnels or clients. It is safe to use from multiple threads; a connection for the same
+    key is only created once at a time.
+
+    Entries that fail :meth:`check_connection` are closed and replaced by a new connection. The following ``env``
+    variables limit the cache; both are disabled by default:
+
+    * ``env.docker_connection_cache_size``: Maximum number of connections. If exceeded, the least recently used
+      connections are closed.
+    * ``env.docker_connection_idle_ttl``: Time in seconds, after which an unused connection is closed.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ConnectionDict, self).__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+        # Lock and number of threads using it per key.
+        self._key_locks = {}
+        self._last_used = {}
+
+    def _drop_key_lock(self, key):
+        key_lock = self._key_locks.get(key)
+        if key_lock is not None and not key_lock[1] and key not in self:
+            del self._key_locks[key]
+
+    @contextmanager
+    def _key_lock(self, key):
+        with self._lock:
+            key_lock = self._key_locks.get(key)
+            if key_lock is None:
+                self._key_locks[key] = key_lock = [threading.RLock(), 0]
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                yield
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                self._drop_key_lock(key)
+
+    def _expire(self, current_key):
+        max_size = env.get('docker_connection_cache_size')
+        idle_ttl = env.get('docker_connection_idle_ttl')
+        if not (max_size or idle_ttl):
+            return
+        now = time.time()
+        with self._lock:
+            by_use = sorted(((key, last_used) for key, last_used in self._last_used.items() if key != current_key),
+                            key=lambda item: item[1])
+            if idle_ttl:
+                expired = [key for key, last_used in by_use if now - last_used > idle_ttl]
+            else:
+                expired = []
+            if max_size:
+                remaining = [key for key, last_used in by_use if key not in expired]
+                excess = len(remaining) + 1 - int(max_size)
+                if excess > 0:
+                    expired.extend(remaining[:excess])
+        for key in expired:
+            log.debug("Closing %s connection for key %s.", self.__class__.__name__, key)
+            self.remove_connection(key)
+
     def get_or_create_connection(self, key, d, *args, **kwargs):
-        e = self.get(key)
-        if e is None:
-            log.debug("Creating new %s connection for key %s with args: %s, kwargs: %s",
-                      self.__class__.__name__, key, args, kwargs)
-            self[key] = e = d(*args, **kwargs)
+        """
+        Returns a connection from the cache. If there is no connection for the key yet, or if the existing connection
+        fails the check, creates a new one.
+
+        :param key: Cache key.
+        :param d: Callable for creating a new connection.
+        :param args: Positional arguments to ``d``.
+        :param kwargs: Keyword arguments to ``d``.
+        :return: Connection object.
+        """
+        with self._key_lock(key):
+            e = self.get(key)
+            if e is not None:
+                idle_time = time.time() - self._last_used.get(key, 0)
+                if not self.check_connection(e, idle_time):
+                    log.info("Replacing %s connection for key %s, which is no longer usable.",
+                             self.__class__.__name__, key)
+                    self.remove_connection(key)
+                    e = None
+            if e is None:
+                log.debug("Creating new %s connection for key %s with args: %s, kwargs: %s",
+                          self.__class__.__name__, key, args, kwargs)
+                self[key] = e = d(*args, **kwargs)
+            self._last_used[key] = time.time()
+        self._expire(key)
         return e
 
+    def check_connection(self, connection, idle_time):
+        """
+        Checks if a cached connection is still usable. Always returns ``True`` here; can be overridden for liveness
+        probes.
+
+        :param connection: Connection object.
+        :param idle_time: Time in seconds since the connection has last been retrieved from the cache.
+        :type idle_time: float
+        :return: ``True`` if the connection can be re-used, ``False`` if it should be replaced.
+        :rtype: bool
+        """
+        return True
+
+    def close_connection(self, connection):
+        """
+        Closes a connection that is removed from the cache.
+
+        :param connection: Connection object.
+        """
+        close = getattr(connection, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                log.exception("Error while closing %s connection.", self.__class__.__name__)
+
+    def remove_connection(self, key):
+        """
+        Removes a connection from the cache and closes it.
+
+        :param key: Cache key.
+        """
+        with self._lock:
+            e = self.pop(key, None)
+            self._last_used.pop(key, None)
+            self._drop_key_lock(key)
+        if e is not None:
+            self.close_connection(e)
+
+    def close_all(self):
+        """
+        Removes and closes all connections of this cache.
+        """
+        for key in list(self.keys()):
+            self.remove_connection(key)
+
 
 class DockerConnectionDict(ConnectionDict):
     """
@@ -51,12 +183,133 @@ class DockerConnectionDict(ConnectionDict):
         key = env.get('host_string'), kwargs.get('base_url', env.get('docker_base_url'))
         default_config = _get_default_config(None)
         if default_config:
-            if key not in self:
-                self[key] = default_config
-            return default_config.get_client()
-        config = self.get_or_create_connection(key, self.configuration_class, *args, **kwargs)
+            config = self.get_or_create_connection(key, lambda: default_config)
+        else:
+            config = self.get_or_create_connection(key, self.configuration_class, *args, **kwargs)
         return config.get_client()
 
+    def check_client(self, client, idle_time):
+        """
+        Checks if a client that has been instantiated from a cached configuration is still usable. Always returns
+        ``True`` here; can be overridden for liveness probes.
+
+        :param client: Docker client.
+        :param idle_time: Time in seconds since the client has last been retrieved from the cache.
+        :type idle_time: float
+        :return: ``True`` if the client can be re-used, ``False`` if it should be replaced.
+        :rtype: bool
+        """
+        return True
+
+    def check_connection(self, connection, idle_time):
+        client = connection.client
+        return client is None or self.check_client(client, idle_time)
+
+    def close_connection(self, connection):
+        # The configuration object may be re-used (e.g. from ``env.docker_clients``), so only the client is discarded.
+        client = connection.client
+        if client is not None:
+            connection.client = None
+            super(DockerConnectionDict, self).close_connection(client)
+
+
+def _not_found(message):
+    # docker-py's errors need a response for their string representation.
+    response = requests.Response()
+    response.status_code = 404
+    response.reason = 'Not Found'
+    return NotFound(message, response, explanation=message)
+
+
+def _unique(items):
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+
+class InspectPrefetchMixin(object):
+    """
+    Adds methods for inspecting multiple containers, networks, or volumes at once. Results are kept on the client, and
+    each of them is returned once by the next call to ``inspect_container``, ``inspect_network``, or ``inspect_volume``
+    with the same name or id, without requesting it again. This way, a batch can be fetched before e.g. checking the
+    state of all containers of a map. Objects that do not exist are not included in the result, and their next
+    inspection raises :class:`~docker.errors.NotFound`. Objects that cannot be inspected for other reasons are neither
+    included nor kept, so that their next inspection makes a new request and raises the actual error.
+
+    Implementations call :meth:`_init_prefetch` and provide ``_inspect_many``.
+    """
+    def _init_prefetch(self):
+        self._prefetched = {}
+
+    def _inspect_many(self, item_type, keys):
+        """
+        Returns the details of all objects found by the name or id passed in, and the names or ids that could not be
+        inspected for other reasons than that the object does not exist.
+        """
+        raise NotImplementedError()
+
+    def _prefetch(self, item_type, keys):
+        keys = _unique(keys)
+        if not keys:
+            return {}
+        results, failed = self._inspect_many(item_type, keys)
+        type_prefetched = self._prefetched.setdefault(item_type, {})
+        for key in keys:
+            # Nothing is known about whether objects that failed to be inspected exist.
+            if key not in failed:
+                type_prefetched[key] = results.get(key)
+        return results
+
+    def _get_prefetched(self, item_type, key):
+        """
+        Returns and removes a prefetched result, or ``None`` if the object has not been prefetched.
+        """
+        type_prefetched = self._prefetched.get(item_type)
+        if not type_prefetched or not isinstance(key, six.string_types) or key not in type_prefetched:
+            return None
+        detail = type_prefetched.pop(key)
+        if detail is None:
+            raise _not_found("{0} not found.".format(item_type.title()))
+        return detail
+
+    def clear_prefetched(self):
+        """
+        Discards all prefetched results.
+        """
+        self._prefetched.clear()
+
+    def inspect_containers(self, containers):
+        """
+        Inspects multiple containers at once.
+
+        :param containers: Container names or ids.
+        :type containers: collections.Iterable[unicode]
+        :return: Container details, by the name or id as passed in.
+        :rtype: dict[unicode, dict]
+        """
+        return self._prefetch('container', containers)
+
+    def inspect_networks(self, networks):
+        """
+        Inspects multiple networks at once.
+
+        :param networks: Network names or ids.
+        :type networks: collections.Iterable[unicode]
+        :return: Network details, by the name or id as passed in.
+        :rtype: dict[unicode, dict]
+        """
+        return self._prefetch('network', networks)
+
+    def inspect_volumes(self, volumes):
+        """
+        Inspects multiple volumes at once.
+
+        :param volumes: Volume names.
+        :type volumes: collections.Iterable[unicode]
+        :return: Volume details, by name.
+        :rtype: dict[unicode, dict]
+        """
+        return self._prefetch('volume', volumes)
+
 
 class FabricClientConfiguration(ClientConfiguration):
     def get_client(self):
@@ -115,6 +368,17 @@ class FabricContainerClient(MappingDockerClient):
 
 
 def get_local_port(init_port):
+    """
+    Returns the next local port for a tunnel, by adding a process-wide offset to the initial port. For ``0`` (an
+    ephemeral port assigned by the operating system), the offset is not applied.
+
+    :param init_port: Initial port number.
+    :type init_port: int
+    :return: Port number.
+    :rtype: int
+    """
+    if not int(init_port):
+        return 0
     with port_offset.get_lock():
         current_offset = port_offset.value
         port_offset.value += 1
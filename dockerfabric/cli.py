@@ -1,22 +1,60 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+import json
+import logging
 import os
 import posixpath
+import socket
+import tarfile
+import threading
+import time
+import uuid
 
 from fabric.api import cd, env, fastprint, get, put, run, settings, sudo
-from fabric.network import needs_host
+from fabric.network import join_host_strings, needs_host, normalize, to_dict
+from fabric.utils import error, puts
+import six
+from six.moves import queue, shlex_quote
 
 from dockermap.api import USE_HC_MERGE
-from dockermap.client.cli import (DockerCommandLineOutput, parse_containers_output, parse_inspect_output,
-                                  parse_images_output, parse_version_output, parse_top_output, parse_networks_output,
-                                  parse_volumes_output)
+from dockermap.client.cli import (CONTAINER_FORMAT_ARG, DockerCommandLineOutput, parse_containers_output,
+                                  parse_inspect_output, parse_images_output, parse_version_output, parse_top_output,
+                                  parse_networks_output, parse_volumes_output)
 from dockermap.client.docker_util import DockerUtilityMixin
 from dockermap.shortcuts import chmod, chown, targz, mkdir
 
-from .base import DockerConnectionDict, FabricContainerClient, FabricClientConfiguration
+from .base import DockerConnectionDict, FabricContainerClient, FabricClientConfiguration, InspectPrefetchMixin
+from .parallel import HostResult, ParallelResults, execute_parallel
+from .shell import remote_shells
+from .tunnel import channel_schedulers
+from .utils.cli_output import get_json_format_arg, parse_json_output
 from .utils.containers import temp_container
-from .utils.files import temp_dir, is_directory
+from .utils.files import _safe_name, temp_dir, is_directory
+from .utils.output import stdout_result
+from .utils.streams import (COMPRESSION_GZIP, COMPRESSION_ZSTD, DEFAULT_CHUNK_SIZE, TransferProgress,
+                            detect_compression, get_compressing_writer, iter_tar_stream, read_chunks)
+from .utils.version_cache import api_version_cache
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+RELAY_BUFFER_SIZE = 1024 * 1024
+RELAY_QUEUE_SIZE = 16
+REMOTE_COMPRESSORS = {
+    COMPRESSION_GZIP: ('pigz', 'pigz -c'),
+    COMPRESSION_ZSTD: ('zstd', 'zstd -T0 -c'),
+}
+ARCHIVE_EXTENSIONS = {
+    COMPRESSION_GZIP: '.tar.gz',
+    COMPRESSION_ZSTD: '.tar.zst',
+    None: '.tar',
+}
+
+ImageSyncResult = namedtuple('ImageSyncResult', ['layers', 'transferred_layers', 'transferred_bytes'])
 
 
 def _find_image_id(output):
@@ -26,7 +64,145 @@ def _find_image_id(output):
     return None
 
 
-class DockerCliClient(DockerUtilityMixin):
+def _run_in_shell(use_sudo, cmd, **kwargs):
+    return remote_shells[(env.host_string, use_sudo)].run(cmd, **kwargs)
+
+
+class BatchedCommand(object):
+    """
+    Command queued in a :class:`CommandBatch`. Exit code and output are available after the batch has been run; both
+    remain ``None`` if the command has not been run, e.g. because the shell has terminated before.
+
+    :param cmd: Command line.
+    :type cmd: unicode
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.return_code = None
+        self.output = None
+
+    @property
+    def executed(self):
+        return self.return_code is not None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+
+class CommandBatch(object):
+    """
+    Runs multiple independent commands in a single remote shell, instead of one Fabric ``run`` or ``sudo`` each. The
+    exit code of each command is written as a delimiter after its output, so that exit codes and outputs can be
+    assigned to the single commands. Each command runs in a subshell, so that changes of the directory or variables do
+    not affect the following commands. All commands are run, even if one of them fails; failures are reported
+    afterwards.
+
+    :param call_method: Fabric function for running the commands, i.e. ``run`` or ``sudo``.
+    :type call_method: callable
+    :param echo: Print each command along with its output.
+    :type echo: bool
+    :param max_commands: Maximum number of commands to run in one shell. By default uses
+      ``env.docker_cli_batch_size`` or 50.
+    :type max_commands: int
+    """
+    def __init__(self, call_method, echo=False, max_commands=None):
+        self.call_method = call_method
+        self.echo = echo
+        self.max_commands = int(max_commands or env.get('docker_cli_batch_size') or DEFAULT_BATCH_SIZE)
+        self.queued = []
+
+    def add(self, cmd):
+        """
+        Queues a command.
+
+        :param cmd: Command line.
+        :type cmd: unicode
+        :rtype: BatchedCommand
+        """
+        command = BatchedCommand(cmd)
+        self.queued.append(command)
+        return command
+
+    def _run(self, commands):
+        marker = 'DOCKERFABRIC_EXIT_{0}'.format(uuid.uuid4().hex)
+        # A subshell per command keeps the others running if one of them calls exit.
+        script = ''.join('( {0}\n) 2>&1; echo {1} $?\n'.format(command.cmd, marker) for command in commands)
+        output = self.call_method(script, shell=True, quiet=True)
+        command_iter = iter(commands)
+        current = next(command_iter)
+        lines = []
+        for line in output.splitlines():
+            line = line.rstrip('\r')
+            output_line, found, return_code = line.partition(marker)
+            if not found:
+                lines.append(line)
+                continue
+            if output_line:
+                lines.append(output_line)
+            current.output = '\n'.join(lines)
+            current.return_code = int(return_code)
+            lines = []
+            try:
+                current = next(command_iter)
+            except StopIteration:
+                break
+
+    def flush(self):
+        """
+        Runs all queued commands. If any of them has failed, calls :func:`~fabric.utils.error` with the command and
+        its output.
+
+        :return: The commands that have been run.
+        :rtype: list[BatchedCommand]
+        """
+        commands, self.queued = self.queued, []
+        for i in range(0, len(commands), self.max_commands):
+            self._run(commands[i:i + self.max_commands])
+        failed = []
+        for command in commands:
+            if self.echo:
+                puts("batch: {0}".format(command.cmd))
+            if command.output:
+                puts(command.output)
+            if not command.executed:
+                failed.append("Command '{0}' has not been run.".format(command.cmd))
+            elif command.return_code != 0:
+                failed.append("Command '{0}' failed with exit code {1}: {2}".format(command.cmd, command.return_code,
+                                                                                   command.output))
+        if failed:
+            error('\n'.join(failed))
+        return commands
+
+
+def _match_inspected(items, keys):
+    """
+    Assigns the output of ``docker inspect`` to the names or ids it was requested with. Like on the Docker service,
+    names and full ids take precedence over id prefixes, which have to be unique.
+    """
+    by_name = {}
+    for item in items:
+        if 'Id' in item:
+            by_name[item['Id']] = item
+    for item in items:
+        if 'Name' in item:
+            by_name[item['Name'].lstrip('/')] = item
+    results = {}
+    failed = []
+    for key in keys:
+        item = by_name.get(key)
+        if item is None:
+            matches = [item for item in items if item.get('Id', '').startswith(key)]
+            if len(matches) == 1:
+                item = matches[0]
+            elif matches:
+                failed.append(key)
+        if item is not None:
+            results[key] = item
+    return results, failed
+
+
+class DockerCliClient(InspectPrefetchMixin, DockerUtilityMixin):
     """
     Docker client for Fabric using the command line interface on a remote host.
 
@@ -44,8 +220,17 @@ class DockerCliClient(DockerUtilityMixin):
     :param debug: If set to ``True``, echoes each command and its console output. Some commands are echoed either way
      for some feedback.
     :type debug: bool
+    :param persistent_shell: Run commands in a shell that is kept open on the remote host (see
+     :class:`~dockerfabric.shell.RemoteShell`), instead of running each of them through Fabric. If not set, will refer
+     to ``env.docker_cli_persistent_shell``.
+    :type persistent_shell: bool
+    :param json_output: List containers, images, networks, and volumes in JSON format, instead of parsing the tables
+     printed by the command line. Requires Docker 1.13 or later. If not set, will refer to
+     ``env.docker_cli_json_output``.
+    :type json_output: bool
     """
-    def __init__(self, cmd_prefix=None, default_bin=None, base_url=None, tls=None, use_sudo=None, debug=None):
+    def __init__(self, cmd_prefix=None, default_bin=None, base_url=None, tls=None, use_sudo=None, debug=None,
+                 persistent_shell=None, json_output=None):
         super(DockerCliClient, self).__init__()
         base_url = base_url or env.get('docker_base_url')
         if base_url:
@@ -56,18 +241,70 @@ class DockerCliClient(DockerUtilityMixin):
             cmd_args.append('--tls')
         self._out = DockerCommandLineOutput(cmd_prefix or env.get('docker_cli_prefix'),
                                             default_bin or env.get('docker_cli_bin', 'docker'), cmd_args or None)
-        if use_sudo or (use_sudo is None and env.get('docker_cli_sudo')):
+        call_sudo = use_sudo or (use_sudo is None and env.get('docker_cli_sudo'))
+        if persistent_shell or (persistent_shell is None and env.get('docker_cli_persistent_shell')):
+            self._call_method = partial(_run_in_shell, bool(call_sudo))
+        elif call_sudo:
             self._call_method = sudo
         else:
             self._call_method = run
         self._quiet = not (debug or (debug is None and env.get('docker_cli_debug')))
+        self._json_output = json_output or (json_output is None and env.get('docker_cli_json_output'))
         self.api_version = None
+        self._batch = None
+        self._verify_version = False
+        self._init_prefetch()
         self._update_api_version()
 
-    def _call(self, cmd, quiet=False):
-        if cmd:
-            return self._call_method(cmd, shell=False, quiet=quiet and self._quiet)
-        return None
+    def _call(self, cmd, quiet=False, deferrable=False, warn_only=False):
+        if not cmd:
+            return None
+        if self._verify_version:
+            self._verify_version = False
+            self._fetch_api_version()
+        if self._batch is not None:
+            if deferrable:
+                return self._batch.add(cmd)
+            # The command may depend on the ones queued before.
+            self._batch.flush()
+        if warn_only:
+            return self._call_method(cmd, shell=False, quiet=quiet and self._quiet, warn_only=True)
+        return self._call_method(cmd, shell=False, quiet=quiet and self._quiet)
+
+    def _list(self, c_cmd, item_type, parse_table, args, kwargs):
+        fields = kwargs.pop('fields', None)
+        cmd_str = self._out.get_cmd(c_cmd, *args, **kwargs)
+        if not self._json_output:
+            return parse_table(self._call(cmd_str, quiet=True))
+        cmd_str = '{0} {1}'.format(cmd_str.replace(' {0}'.format(CONTAINER_FORMAT_ARG), ''),
+                                   get_json_format_arg(item_type, fields))
+        return parse_json_output(self._call(cmd_str, quiet=True), item_type, fields)
+
+    @contextmanager
+    def batch(self, max_commands=None):
+        """
+        Context manager for queuing commands that do not return a result, such as ``start``, ``stop``, or
+        ``remove_container``, instead of running each of them separately. Queued commands are run together in one
+        remote shell, when leaving the context or when another command needs to run. Methods called within the context
+        return a :class:`BatchedCommand` instead of running the command immediately. Can be nested.
+
+        If the block raises an exception, commands still queued are discarded.
+
+        :param max_commands: Maximum number of commands to run in one shell. By default uses
+          ``env.docker_cli_batch_size`` or 50.
+        :type max_commands: int
+        :return: The batch.
+        :rtype: CommandBatch
+        """
+        if self._batch is not None:
+            yield self._batch
+            return
+        self._batch = CommandBatch(self._call_method, not self._quiet, max_commands)
+        try:
+            yield self._batch
+            self._batch.flush()
+        finally:
+            self._batch = None
 
     def create_container(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('create_container', *args, **kwargs)
@@ -75,46 +312,61 @@ class DockerCliClient(DockerUtilityMixin):
 
     def start(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('start', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def restart(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('restart', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def stop(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('stop', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def remove_container(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('remove_container', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def remove_image(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('remove_image', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def kill(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('kill', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def wait(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('wait', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def containers(self, *args, **kwargs):
-        cmd_str = self._out.get_cmd('containers', *args, **kwargs)
-        res = self._call(cmd_str, quiet=True)
-        return parse_containers_output(res)
+        return self._list('containers', 'container', parse_containers_output, args, kwargs)
+
+    def _inspect_many(self, item_type, keys):
+        if item_type == 'container':
+            cmd_str = self._out.get_cmd('inspect_container', *keys, type='container')
+        else:
+            cmd_str = self._out.get_cmd('inspect_{0}'.format(item_type), *keys)
+        # Missing objects are only reported on stderr and in the exit code; the others are still printed.
+        res = self._call('{0} 2>/dev/null'.format(cmd_str), quiet=True, warn_only=True)
+        try:
+            items = json.loads(res)
+        except (TypeError, ValueError):
+            items = None
+        if not isinstance(items, list):
+            log.warning("Failed to inspect %ss; docker exited with code %s.", item_type, res.return_code)
+            return {}, keys
+        return _match_inspected(items, keys)
 
     def inspect_container(self, *args, **kwargs):
+        detail = self._get_prefetched('container', args[0] if args else kwargs.get('container'))
+        if detail is not None:
+            return detail
         cmd_str = self._out.get_cmd('inspect_container', *args, **kwargs)
         res = self._call(cmd_str, quiet=True)
         return parse_inspect_output(res, 'container')
 
     def images(self, *args, **kwargs):
-        cmd_str = self._out.get_cmd('images', *args, **kwargs)
-        res = self._call(cmd_str, quiet=True)
-        return parse_images_output(res)
+        return self._list('images', 'image', parse_images_output, args, kwargs)
 
     def pull(self, repository, tag=None, **kwargs):
         repo_tag = '{0}:{1}'.format(repository, tag) if tag else repository
@@ -132,22 +384,23 @@ class DockerCliClient(DockerUtilityMixin):
 
     def remove_network(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('remove_network', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def connect_container_to_network(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('connect_container_to_network', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def disconnect_container_from_network(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('disconnect_container_from_network', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def networks(self, *args, **kwargs):
-        cmd_str = self._out.get_cmd('networks', *args, **kwargs)
-        res = self._call(cmd_str, quiet=True)
-        return parse_networks_output(res)
+        return self._list('networks', 'network', parse_networks_output, args, kwargs)
 
     def inspect_network(self, *args, **kwargs):
+        detail = self._get_prefetched('network', args[0] if args else kwargs.get('net_id'))
+        if detail is not None:
+            return detail
         cmd_str = self._out.get_cmd('inspect_network', *args, **kwargs)
         res = self._call(cmd_str, quiet=True)
         return parse_inspect_output(res, 'network')
@@ -158,14 +411,15 @@ class DockerCliClient(DockerUtilityMixin):
 
     def remove_volume(self, *args, **kwargs):
         cmd_str = self._out.get_cmd('remove_volume', *args, **kwargs)
-        self._call(cmd_str)
+        return self._call(cmd_str, deferrable=True)
 
     def volumes(self, *args, **kwargs):
-        cmd_str = self._out.get_cmd('volumes', *args, **kwargs)
-        res = self._call(cmd_str, quiet=True)
-        return {'Volumes': parse_volumes_output(res), 'Warnings': None}
+        return {'Volumes': self._list('volumes', 'volume', parse_volumes_output, args, kwargs), 'Warnings': None}
 
     def inspect_volume(self, *args, **kwargs):
+        detail = self._get_prefetched('volume', args[0] if args else kwargs.get('name'))
+        if detail is not None:
+            return detail
         cmd_str = self._out.get_cmd('inspect_volume', *args, **kwargs)
         res = self._call(cmd_str, quiet=True)
         return parse_inspect_output(res, 'volume')
@@ -252,21 +506,39 @@ class DockerCliClient(DockerUtilityMixin):
     def push_log(self, info, level, *args, **kwargs):
         pass
 
+    def _get_version_cache_key(self):
+        return '{0} {1}'.format(env.host_string, self._out.get_cmd('version'))
+
+    def _fetch_api_version(self):
+        version_dict = self.version()
+        api_version = version_dict.get('APIVersion') or version_dict.get('ApiVersion')
+        if not api_version:
+            return
+        if self.api_version and api_version != self.api_version:
+            log.info("API version on %s has changed from %s to %s.", env.host_string, self.api_version, api_version)
+            client_configuration = getattr(self, 'client_configuration', None)
+            if client_configuration is not None:
+                client_configuration.version = api_version
+        self.api_version = api_version
+        api_version_cache.set(self._get_version_cache_key(), api_version)
+
     def _update_api_version(self):
         if self.api_version and self.api_version != 'auto':
             return
-        version_dict = self.version()
-        if 'APIVersion' in version_dict:
-            self.api_version = version_dict['APIVersion']
-        elif 'ApiVersion' in version_dict:
-            self.api_version = version_dict['ApiVersion']
+        cached_version = api_version_cache.get(self._get_version_cache_key())
+        if cached_version:
+            self.api_version = cached_version
+            self._verify_version = bool(env.get('docker_api_version_verify'))
+        else:
+            self._fetch_api_version()
 
     def run_cmd(self, command):
         sudo(command)
 
 
 class DockerCliConfig(FabricClientConfiguration):
-    init_kwargs = 'base_url', 'tls', 'cmd_prefix', 'default_bin', 'use_sudo', 'debug'
+    init_kwargs = ('base_url', 'tls', 'cmd_prefix', 'default_bin', 'use_sudo', 'debug', 'persistent_shell',
+                   'json_output')
     client_constructor = DockerCliClient
 
     def update_settings(self, **kwargs):
@@ -286,21 +558,100 @@ docker_cli = DockerCliConnections().get_connection
 container_cli = ContainerCliFabricClient
 
 
+def _rewrite_members(archive, root_name, contents_only):
+    prefix = root_name + '/'
+    for member in archive:
+        if contents_only and member.name.startswith(prefix):
+            member.name = member.name[len(prefix):]
+            if member.islnk() and member.linkname.startswith(prefix):
+                member.linkname = member.linkname[len(prefix):]
+        elif contents_only and member.isdir() and member.name.rstrip('/') == root_name:
+            continue
+        yield member
+
+
+def _remove_created(local_path, names):
+    for name in reversed(names):
+        path = os.path.join(local_path, name) if name else local_path
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _stream_resource(container, resource, local_path, contents_only, extract):
+    root_name = posixpath.basename(resource.rstrip('/'))
+    cmd = 'docker cp {0}:{1} -'.format(container, resource)
+    # Only what did not exist before is removed if extracting fails.
+    created = [] if os.path.lexists(local_path) else ['']
+    temp_path = '{0}.{1}.tmp'.format(local_path, os.getpid())
+    completed = False
+    channel = _open_docker_session(env.host_string, cmd)
+    try:
+        try:
+            archive = tarfile.open(fileobj=channel.makefile('rb'), mode='r|')
+            members = _rewrite_members(archive, root_name, contents_only)
+            if extract:
+                for member in members:
+                    if _safe_name(member):
+                        if not os.path.lexists(os.path.join(local_path, member.name)):
+                            created.append(member.name)
+                        archive.extract(member, local_path)
+            else:
+                with tarfile.open(temp_path, 'w|gz') as local_archive:
+                    for member in members:
+                        local_archive.addfile(member, archive.extractfile(member) if member.isfile() else None)
+        except tarfile.TarError as e:
+            tar_error = e
+        else:
+            tar_error = None
+        status = channel.recv_exit_status()
+        if status:
+            message = channel.makefile_stderr('r').read().strip()
+            error("{0} failed: {1}".format(cmd, message or status))
+        elif tar_error is not None:
+            raise tar_error
+        if not extract:
+            os.rename(temp_path, local_path)
+        completed = True
+    finally:
+        channel.close()
+        if not completed:
+            if extract:
+                _remove_created(local_path, created)
+            else:
+                _remove_created(temp_path, [''])
+
+
 @needs_host
-def copy_resource(container, resource, local_filename, contents_only=True):
+def copy_resource(container, resource, local_filename, contents_only=True, stream=True, extract=False):
     """
-    Copies a resource from a container to a compressed tarball and downloads it.
+    Copies a resource from a container to a compressed tarball and downloads it. By default, the output of
+    ``docker cp`` is streamed to the local file, so that neither a copy nor an archive is stored on the remote host. If
+    streaming fails, the incomplete tarball or the extracted files are removed.
 
     :param container: Container name or id.
     :type container: unicode
     :param resource: Name of resource to copy.
     :type resource: unicode
-    :param local_filename: Path to store the tarball locally.
+    :param local_filename: Path to store the tarball locally. With ``extract``, this is the local directory instead.
     :type local_filename: unicode
     :param contents_only: In case ``resource`` is a directory, put all contents at the root of the tar file. If this is
       set to ``False``, the directory itself will be at the root instead.
     :type contents_only: bool
+    :param stream: Stream the resource. If set to ``False``, the resource is copied to a temporary directory on the
+      remote host, and compressed and downloaded from there.
+    :type stream: bool
+    :param extract: Extract the resource into the local directory ``local_filename`` while it is received, instead of
+      storing a tarball. Requires ``stream``.
+    :type extract: bool
     """
+    if stream:
+        _stream_resource(container, resource, local_filename, contents_only, extract)
+        return
     with temp_dir() as remote_tmp:
         base_name = os.path.basename(resource)
         copy_path = posixpath.join(remote_tmp, 'copy_tmp')
@@ -320,6 +671,40 @@ def copy_resource(container, resource, local_filename, contents_only=True):
         get(archive_path, local_filename)
 
 
+@needs_host
+def put_resource(container, local_path, container_path, apply_chown=None, apply_chmod=None):
+    """
+    Uploads a local file or directory into a container through an SSH channel to ``docker cp - <container>:<path>``.
+    The archive is generated while it is sent, so that nothing is stored on the remote host. Owner and permissions are
+    set in the archive.
+
+    :param container: Container name or id.
+    :type container: unicode
+    :param local_path: Local file or directory. Contents of a directory are placed in ``container_path``.
+    :type local_path: unicode
+    :param container_path: Existing directory in the container.
+    :type container_path: unicode
+    :param apply_chown: Owner to set for the uploaded files, as numeric ids in the notation ``user:group``, or as a
+      tuple ``(user, group)``.
+    :type apply_chown: unicode | int | tuple
+    :param apply_chmod: Permissions to set for the uploaded files, in octal notation; directories also get execute
+      permissions where they are readable.
+    :type apply_chmod: unicode | int
+    """
+    cmd = 'docker cp - {0}:{1}'.format(container, container_path)
+    channel = _open_docker_session(env.host_string, cmd)
+    try:
+        for chunk in iter_tar_stream(local_path, apply_chown, apply_chmod):
+            channel.sendall(chunk)
+        channel.shutdown_write()
+        status = channel.recv_exit_status()
+        if status:
+            message = channel.makefile_stderr('r').read().strip()
+            error("{0} failed: {1}".format(cmd, message or status))
+    finally:
+        channel.close()
+
+
 @needs_host
 def copy_resources(src_container, src_resources, storage_dir, dst_directories=None, apply_chown=None, apply_chmod=None):
     """
@@ -406,8 +791,93 @@ def isolate_to_image(src_container, src_resources, dst_image, **kwargs):
             sudo('tar -cz * | docker import - {0}'.format(dst_image))
 
 
+def _get_image_file_name(images, compression):
+    names = []
+    for image in images:
+        r_name, __, i_name = image.rpartition('/')
+        i_name, __, __ = i_name.partition(':')
+        names.append(i_name)
+    return 'image_{0}{1}'.format('_'.join(names), ARCHIVE_EXTENSIONS[compression])
+
+
+def _remote_command_exists(name):
+    return bool(stdout_result('command -v {0}'.format(name), (1, 127), shell=False, quiet=True))
+
+
+@needs_host
+def save_images(images, local_filename, compression=COMPRESSION_GZIP, remote_compression=None, threads=None):
+    """
+    Saves one or multiple Docker images into a single tarball, in which layers shared between the images are only
+    included once. The output of ``docker save`` is streamed through an SSH channel and written to the local file
+    directly, without storing it on the remote host first.
+
+    The archive is compressed on the remote host if the compressor is available there (`pigz` for gzip, or `zstd`),
+    using multiple threads. Otherwise it is compressed locally with multiple threads, while the data is still being
+    received.
+
+    :param images: Image ids or tags.
+    :type images: list[unicode]
+    :param local_filename: Local file name to store the images into. If this is a directory, the images will be stored
+      there as a file named ``image_<Image names>.tar.gz`` (or ``.tar.zst``, ``.tar``).
+    :type local_filename: unicode
+    :param compression: ``gzip``, ``zstd``, or ``None`` for an uncompressed tarball. Local compression with zstd
+      requires the zstandard package.
+    :type compression: unicode
+    :param remote_compression: Whether to compress on the remote host. By default uses
+      ``env.docker_save_remote_compression``; if not set, checks if the compressor is available on the host.
+    :type remote_compression: bool
+    :param threads: Number of threads for local compression. By default uses the number of CPUs.
+    :type threads: int
+    """
+    if os.path.isdir(local_filename):
+        local_filename = os.path.join(local_filename, _get_image_file_name(images, compression))
+    cmd = 'docker save {0}'.format(' '.join(images))
+    if compression:
+        if remote_compression is None:
+            remote_compression = env.get('docker_save_remote_compression')
+        if remote_compression is None:
+            remote_compression = _remote_command_exists(REMOTE_COMPRESSORS[compression][0])
+        if remote_compression:
+            # Without pipefail, a failing docker save would go unnoticed.
+            cmd = "/bin/bash -o pipefail -c '{0} | {1}'".format(cmd, REMOTE_COMPRESSORS[compression][1])
+    progress = TransferProgress("Saving image")
+    channel = _open_docker_session(env.host_string, cmd)
+    file_created = False
+    try:
+        with open(local_filename, 'wb') as f:
+            file_created = True
+            if compression and not remote_compression:
+                writer = get_compressing_writer(f, compression, threads)
+            else:
+                writer = f
+            try:
+                while True:
+                    data = channel.recv(DEFAULT_CHUNK_SIZE)
+                    if not data:
+                        break
+                    progress.update(len(data))
+                    writer.write(data)
+            finally:
+                # Also stops the compression threads.
+                if writer is not f:
+                    writer.close()
+        status = channel.recv_exit_status()
+        if status:
+            message = channel.makefile_stderr('r').read().strip()
+    except Exception:
+        if file_created:
+            os.remove(local_filename)
+        raise
+    finally:
+        channel.close()
+    progress.finish()
+    if status:
+        os.remove(local_filename)
+        error("{0} failed: {1}".format(cmd, message or status))
+
+
 @needs_host
-def save_image(image, local_filename):
+def save_image(image, local_filename, stream=True, **kwargs):
     """
     Saves a Docker image as a compressed tarball. This command line client method is a suitable alternative, if the
     Remove API method is too slow.
@@ -416,7 +886,14 @@ def save_image(image, local_filename):
     :type image: unicode
     :param local_filename: Local file name to store the image into. If this is a directory, the image will be stored
       there as a file named ``image_<Image name>.tar.gz``.
+    :param stream: Stream the image as described in :func:`save_images`. If set to ``False``, the compressed tarball is
+      generated in a temporary directory on the remote host, and downloaded afterwards.
+    :type stream: bool
+    :param kwargs: Additional kwargs for :func:`save_images`, if ``stream`` is set.
     """
+    if stream:
+        save_images([image], local_filename, **kwargs)
+        return
     r_name, __, i_name = image.rpartition('/')
     i_name, __, __ = i_name.partition(':')
     with temp_dir() as remote_tmp:
@@ -425,6 +902,333 @@ def save_image(image, local_filename):
         get(archive, local_filename)
 
 
+@needs_host
+def load_image(local_filename, compression=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Uploads a local image tarball through an SSH channel into ``docker load`` on the remote host. Compressed files are
+    transferred as they are and decompressed on the remote end, which is usually faster than uploading the uncompressed
+    data through the API.
+
+    :param local_filename: Local file name of the image tarball.
+    :type local_filename: unicode
+    :param compression: Compression of the file, ``gzip`` or ``zstd``. If not set, it is detected from the file. For
+      ``zstd``, the `zstd` command has to be available on the remote host.
+    :type compression: unicode
+    :param chunk_size: Size of the chunks read from the file and sent to the remote host.
+    :type chunk_size: int
+    """
+    if compression is None:
+        compression = detect_compression(local_filename)
+    if compression == COMPRESSION_ZSTD:
+        cmd = 'zstd -dc | docker load'
+    else:
+        # docker load decompresses gzip itself.
+        cmd = 'docker load'
+    progress = TransferProgress("Loading image", os.path.getsize(local_filename))
+    channel = _open_docker_session(env.host_string, cmd)
+    try:
+        with open(local_filename, 'rb') as f:
+            for chunk in read_chunks(f, chunk_size, progress):
+                channel.sendall(chunk)
+        channel.shutdown_write()
+        output = channel.makefile('r').read().strip()
+        status = channel.recv_exit_status()
+        if status:
+            message = channel.makefile_stderr('r').read().strip()
+            error("{0} failed: {1}".format(cmd, message or status))
+    finally:
+        channel.close()
+    progress.finish()
+    if output:
+        puts(output)
+
+
+def _get_ssh_command(host_string, ssh_options=None):
+    user, host, port = normalize(host_string)
+    options = ssh_options if ssh_options is not None else env.get('docker_distribute_ssh_options', '-o BatchMode=yes')
+    return 'ssh {0} -p {1} {2}@{3}'.format(options, port, user, host)
+
+
+def _send_image(image, assignments, ssh_options):
+    target = assignments[env.host_string]
+    ssh_cmd = _get_ssh_command(target, ssh_options)
+    # Without pipefail, a failing docker save would go unnoticed if docker load exits normally.
+    cmd = 'docker save {0} | {1} docker load'.format(image, ssh_cmd)
+    run('/bin/bash -o pipefail -c {0}'.format(shlex_quote(cmd)), shell=False)
+    return target
+
+
+def _distribute_direct(image, source_host, target_hosts, fan_out, ssh_options):
+    results = ParallelResults()
+    sources = [source_host]
+    pending = list(target_hosts)
+    while pending:
+        if fan_out:
+            assignments = dict(zip(sources, pending))
+        else:
+            assignments = dict(zip(sources[:1], pending))
+        pending = pending[len(assignments):]
+        round_results = execute_parallel(_send_image, image, assignments, ssh_options, hosts=list(assignments),
+                                         pool_size=len(assignments))
+        for src, src_result in six.iteritems(round_results):
+            target = assignments[src]
+            results[target] = HostResult(target, src, src_result.exception, src_result.duration)
+            if src_result.succeeded:
+                sources.append(target)
+    return results
+
+
+def _open_docker_session(host_string, cmd):
+    channel = channel_schedulers[host_string].open_session(bulk=True)
+    channel.exec_command(cmd)
+    return channel
+
+
+class _RelayTarget(object):
+    # Sends relayed data to one target in a separate thread, so that targets do not have to wait for each other.
+    def __init__(self, host_string, channel):
+        self.host_string = host_string
+        self.channel = channel
+        self.error = None
+        self.last_sent = time.time()
+        self._queue = queue.Queue(RELAY_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._send, name='relay-{0}'.format(host_string))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _send(self):
+        try:
+            while True:
+                data = self._queue.get()
+                if data is None:
+                    return
+                self.channel.sendall(data)
+                self.last_sent = time.time()
+        except socket.error as e:
+            self.error = e
+
+    def put(self, data, timeout):
+        if self.error is None:
+            try:
+                self._queue.put(data, timeout=timeout)
+                return True
+            except queue.Full:
+                self.error = socket.timeout("Timed out sending data to {0}.".format(self.host_string))
+        return False
+
+    def finish(self, timeout):
+        if self.put(None, timeout):
+            while self._thread.is_alive():
+                self._thread.join(1)
+                if self._thread.is_alive() and time.time() - self.last_sent > timeout:
+                    self.error = socket.timeout("Timed out sending data to {0}.".format(self.host_string))
+                    break
+        return self.error is None
+
+    def close(self):
+        self.channel.close()
+        try:
+            # Ends the thread in case it is waiting for data.
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+def _relay_stream(source_host, source_cmd, target_hosts, target_cmd):
+    timeout = float(env.get('docker_relay_timeout') or 60)
+    with settings(host_string=source_host):
+        src_channel = _open_docker_session(source_host, source_cmd)
+    targets = []
+    failed = {}
+    try:
+        for target_host in target_hosts:
+            with settings(host_string=target_host):
+                targets.append(_RelayTarget(target_host, _open_docker_session(target_host, target_cmd)))
+        while targets:
+            data = src_channel.recv(RELAY_BUFFER_SIZE)
+            if not data:
+                break
+            for target in list(targets):
+                if not target.put(data, timeout):
+                    failed[target.host_string] = target.error
+                    targets.remove(target)
+                    target.close()
+        if not targets:
+            # The source is not read any further, so its exit status would never be available.
+            return failed
+        src_status = src_channel.recv_exit_status()
+        if src_status:
+            message = src_channel.makefile_stderr('r').read().strip()
+            error_message = "{0} failed on {1}: {2}".format(source_cmd, source_host, message or src_status)
+            for target in targets:
+                failed[target.host_string] = Exception(error_message)
+        for target in targets:
+            if not target.finish(timeout):
+                failed[target.host_string] = target.error
+                continue
+            target.channel.shutdown_write()
+            status = target.channel.recv_exit_status()
+            if status and target.host_string not in failed:
+                message = target.channel.makefile_stderr('r').read().strip()
+                failed[target.host_string] = Exception("{0} failed: {1}".format(target_cmd, message or status))
+    finally:
+        src_channel.close()
+        for target in targets:
+            target.close()
+    return failed
+
+
+def _distribute_relay(image, source_host, target_hosts):
+    start_ts = time.time()
+    failed = _relay_stream(source_host, 'docker save {0}'.format(image), target_hosts, 'docker load')
+    duration = time.time() - start_ts
+    results = ParallelResults()
+    for target in target_hosts:
+        results[target] = HostResult(target, source_host, failed.get(target), duration)
+    return results
+
+
+def distribute_image(image, source_host, target_hosts, fan_out=True, relay=False, ssh_options=None):
+    """
+    Copies an image from one host to others by streaming the output of ``docker save`` into ``docker load``, without
+    storing it in a file.
+
+    By default, the source host connects to each target host through SSH directly, i.e. the image is not transferred
+    through the local machine. This requires that the source can log into the target with the same host string and
+    without a password prompt, e.g. with agent forwarding (``env.forward_agent = True``). With ``fan_out``, every
+    target that has loaded the image becomes a source for the next ones, so that the number of hosts with the image
+    doubles in each round.
+
+    With ``relay``, the image is read from the source through the local SSH connection and written to all targets at
+    the same time. This works when the hosts cannot reach each other. Targets that do not accept data for
+    ``env.docker_relay_timeout`` seconds (default 60) are dropped and reported as failed.
+
+    :param image: Image name or id.
+    :type image: unicode
+    :param source_host: Host string of the host that has the image.
+    :type source_host: unicode
+    :param target_hosts: Host strings to copy the image to.
+    :type target_hosts: list[unicode]
+    :param fan_out: Use hosts that have received the image as additional sources.
+    :type fan_out: bool
+    :param relay: Transfer the image through the local machine instead of directly between hosts.
+    :type relay: bool
+    :param ssh_options: Options for the `ssh` command on the source host. If not set, will use
+      ``env.docker_distribute_ssh_options`` or ``-o BatchMode=yes``.
+    :type ssh_options: unicode
+    :return: Results per target host, with the host it has received the image from as result.
+    :rtype: dockerfabric.parallel.ParallelResults
+    """
+    if relay:
+        return _distribute_relay(image, source_host, target_hosts)
+    return _distribute_direct(image, source_host, target_hosts, fan_out, ssh_options)
+
+
+def _get_image_layers(image):
+    cmd = "docker inspect --type image --format '{{{{.Id}}}} {{{{json .RootFS.Layers}}}}' {0}".format(image)
+    output = stdout_result(cmd, (1,), shell=False, quiet=True)
+    if not output:
+        return None, []
+    image_id, __, layers = output.strip().partition(' ')
+    return image_id, json.loads(layers) or []
+
+
+def _get_present_layers():
+    cmd = "docker images -aq | xargs -r docker inspect --type image --format '{{json .RootFS.Layers}}'"
+    output = stdout_result(cmd, shell=False, quiet=True)
+    return [json.loads(line) or [] for line in output.splitlines() if line.strip()]
+
+
+def _get_shared_layer_count(layers, present_layers):
+    shared = 0
+    for image_layers in present_layers:
+        count = 0
+        for layer, present_layer in zip(layers, image_layers):
+            if layer != present_layer:
+                break
+            count += 1
+        shared = max(shared, count)
+    return shared
+
+
+def _extract_image(image, remote_dir):
+    run('docker save {0} | tar -x -C {1}'.format(image, remote_dir), shell=False)
+    manifest = stdout_result('cat {0}'.format(posixpath.join(remote_dir, 'manifest.json')), shell=False, quiet=True)
+    entry = json.loads(manifest)[0]
+    layer_paths = entry['Layers']
+    with cd(remote_dir):
+        sizes = stdout_result("stat -c '%s %n' {0}".format(' '.join(set(layer_paths))), shell=False, quiet=True)
+    layer_sizes = {}
+    for line in sizes.splitlines():
+        size, __, path = line.strip().partition(' ')
+        layer_sizes[path] = int(size)
+    return entry['Config'], layer_paths, layer_sizes
+
+
+def _sync_image(image, source_host, source_dir, source_info, relay, ssh_options):
+    image_id, layers, config_path, layer_paths, layer_sizes = source_info
+    target = env.host_string
+    target_id, __ = _get_image_layers(image)
+    if target_id == image_id:
+        return ImageSyncResult(len(layers), 0, 0)
+    shared = _get_shared_layer_count(layers, _get_present_layers())
+    # docker load only reads the layer files of a manifest that are not present already.
+    missing_paths = []
+    for path in layer_paths[shared:]:
+        if path not in missing_paths:
+            missing_paths.append(path)
+    tar_cmd = 'tar -c -C {0} manifest.json {1} {2}'.format(source_dir, config_path, ' '.join(missing_paths))
+    if relay:
+        failed = _relay_stream(source_host, tar_cmd, [target], 'docker load')
+        if failed:
+            raise failed[target]
+    else:
+        cmd = '{0} | {1} docker load'.format(tar_cmd, _get_ssh_command(target, ssh_options))
+        with settings(**to_dict(source_host)):
+            run('/bin/bash -o pipefail -c {0}'.format(shlex_quote(cmd)), shell=False)
+    return ImageSyncResult(len(layers), len(layers) - shared, sum(layer_sizes[path] for path in missing_paths))
+
+
+def sync_image(image, source_host, target_hosts, relay=False, ssh_options=None, pool_size=None):
+    """
+    Copies an image from one host to others like :func:`distribute_image`, but only transfers the layers that are
+    missing on each target. The layer chain of the image is compared to the layers of all images on the target; layers
+    that the target already has in the same order are omitted from the archive passed to ``docker load``, together with
+    the image configuration. Targets that already have the image are skipped.
+
+    The whole image is extracted with ``docker save`` into a temporary directory on the source host first, so that the
+    source host needs free disk space for the entire image, regardless of how many layers are transferred. This
+    requires Docker 1.10 or later on all hosts.
+
+    :param image: Image name or id.
+    :type image: unicode
+    :param source_host: Host string of the host that has the image.
+    :type source_host: unicode
+    :param target_hosts: Host strings to copy the image to.
+    :type target_hosts: list[unicode]
+    :param relay: Transfer the layers through the local machine instead of directly between hosts.
+    :type relay: bool
+    :param ssh_options: Options for the `ssh` command on the source host, as in :func:`distribute_image`.
+    :type ssh_options: unicode
+    :param pool_size: Maximum number of targets to transfer to at the same time. By default uses
+      ``env.docker_parallel_pool_size``.
+    :type pool_size: int
+    :return: Results per target host, with :class:`ImageSyncResult` as result of successful hosts.
+    :rtype: dockerfabric.parallel.ParallelResults
+    """
+    # The user and port of the source must not be taken from the target's settings.
+    source_host = join_host_strings(*normalize(source_host))
+    with settings(**to_dict(source_host)):
+        image_id, layers = _get_image_layers(image)
+        if image_id is None:
+            error("Image '{0}' not found on {1}.".format(image, source_host))
+        with temp_dir() as source_dir:
+            config_path, layer_paths, layer_sizes = _extract_image(image, source_dir)
+            source_info = image_id, layers, config_path, layer_paths, layer_sizes
+            return execute_parallel(_sync_image, image, source_host, source_dir, source_info, relay, ssh_options,
+                                    hosts=list(target_hosts), pool_size=pool_size)
+
+
 @needs_host
 def flatten_image(image, dest_image=None, no_op_cmd='/bin/true', create_kwargs={}, start_kwargs={}):
     """
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import sys
+import threading
+import time
+
+from docker.auth import resolve_repository_name
+from docker.utils import parse_repository_tag
+from fabric.api import env
+from fabric.thread_handling import ThreadHandler
+from fabric.utils import fastprint, puts
+import six
+
+from dockermap.client.base import DockerClientWrapper, DockerStatusError
+from .api import docker_api
+from .parallel import execute_parallel
+from .utils.streams import format_size
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PROGRESS_INTERVAL = 2
+
+
+class RegistryLimits(object):
+    """
+    Limits the number of simultaneous pulls from each registry.
+
+    :param limits: Either the maximum number of pulls for every registry, or a dictionary with registry names (e.g.
+      ``docker.io`` or ``registry.example.com:5000``) and their limits. Registries that are not included in the
+      dictionary are not limited.
+    :type limits: int | dict
+    """
+    def __init__(self, limits=None):
+        self.limits = limits
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get_semaphore(self, repository):
+        """
+        Returns the semaphore for the registry of a repository.
+
+        :param repository: Repository name, optionally including the registry.
+        :type repository: unicode
+        :return: Semaphore, or ``None`` if pulls from the registry are not limited.
+        :rtype: threading.Semaphore
+        """
+        registry = resolve_repository_name(repository)[0]
+        if isinstance(self.limits, dict):
+            limit = self.limits.get(registry)
+        else:
+            limit = self.limits
+        if not limit:
+            return None
+        with self._lock:
+            semaphore = self._semaphores.get(registry)
+            if semaphore is None:
+                self._semaphores[registry] = semaphore = threading.Semaphore(int(limit))
+            return semaphore
+
+
+class HostPullStatistics(object):
+    """
+    Progress and outcome of pulling images on one host.
+
+    :param host_string: Fabric host string.
+    :type host_string: unicode
+    """
+    def __init__(self, host_string):
+        self.host_string = host_string
+        self.current_image = None
+        self.image_durations = {}
+        self.start_time = None
+        self.end_time = None
+        self._layers = {}
+
+    def update(self, event):
+        """
+        Updates the layer progress from a status message of the Docker service.
+
+        :param event: Decoded status message.
+        :type event: dict
+        """
+        layer_id = event.get('id')
+        if not layer_id:
+            return
+        current, total = self._layers.get(layer_id, (0, 0))
+        detail = event.get('progressDetail') or {}
+        status = event.get('status')
+        if status == 'Downloading':
+            current = detail.get('current', current)
+            total = detail.get('total', total)
+        elif status == 'Download complete':
+            current = total
+        self._layers[layer_id] = current, total
+
+    @property
+    def bytes_downloaded(self):
+        """
+        Number of bytes downloaded so far, as reported by the Docker service.
+
+        :rtype: int
+        """
+        return sum(current for current, total in list(self._layers.values()))
+
+    @property
+    def duration(self):
+        """
+        Time in seconds spent pulling images.
+
+        :rtype: float
+        """
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+    def __str__(self):
+        return "{0} image(s) in {1:.1f} s, {2} downloaded".format(len(self.image_durations), self.duration,
+                                                                  format_size(self.bytes_downloaded))
+
+
+class FleetPullProgress(object):
+    """
+    Prints a single line about the progress of all hosts at a fixed interval. On a terminal, the line is updated in
+    place.
+
+    :param interval: Time in seconds between updates.
+    :type interval: float
+    """
+    def __init__(self, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.interval = interval
+        self.hosts = {}
+        self.total_hosts = 0
+        self.start_time = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._tty = sys.stdout.isatty()
+        self._last_length = 0
+
+    def start(self, host_strings):
+        self.total_hosts = len(host_strings)
+        self.start_time = time.time()
+        self._thread = ThreadHandler('pull_progress', self._run)
+
+    def add_host(self, host_string):
+        stats = HostPullStatistics(host_string)
+        with self._lock:
+            self.hosts[host_string] = stats
+        return stats
+
+    def get_line(self):
+        """
+        Returns the current progress.
+
+        :rtype: unicode
+        """
+        with self._lock:
+            hosts = list(self.hosts.values())
+        finished = sum(1 for stats in hosts if stats.end_time is not None)
+        total_bytes = sum(stats.bytes_downloaded for stats in hosts)
+        duration = time.time() - self.start_time
+        rate = total_bytes / duration if duration > 0 else 0.0
+        return "Pulling: {0}/{1} hosts finished, {2} active, {3} downloaded ({4}/s)".format(
+            finished, self.total_hosts, len(hosts) - finished, format_size(total_bytes), format_size(rate))
+
+    def _print(self, line):
+        if self._tty:
+            fastprint('\r{0}{1}'.format(line, ' ' * max(self._last_length - len(line), 0)), show_prefix=False)
+            self._last_length = len(line)
+        else:
+            puts(line, show_prefix=False)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._print(self.get_line())
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.thread.join()
+        self._print(self.get_line())
+        if self._tty:
+            fastprint('\n', show_prefix=False)
+
+
+def _pull_image(client, image, stats):
+    repository, tag = parse_repository_tag(image)
+    stats.current_image = image
+    # Uses the docker-py implementation, since DockerClientWrapper only passes formatted progress on.
+    response = super(DockerClientWrapper, client).pull(repository, tag=tag or 'latest', stream=True, decode=True,
+                                                       insecure_registry=env.get('docker_registry_insecure'))
+    for event in response:
+        if 'error' in event:
+            raise DockerStatusError(event['error'], event.get('errorDetail'))
+        stats.update(event)
+
+
+def _pull_images(images, progress, registry_limits):
+    stats = progress.add_host(env.host_string)
+    stats.start_time = time.time()
+    client = docker_api()
+    try:
+        for image in images:
+            semaphore = registry_limits.get_semaphore(image)
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                image_start = time.time()
+                _pull_image(client, image, stats)
+                stats.image_durations[image] = time.time() - image_start
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+    finally:
+        stats.end_time = time.time()
+    return stats
+
+
+def fleet_pull(images, hosts=None, pool_size=None, registry_limits=None, progress_interval=None):
+    """
+    Pulls images on multiple hosts at the same time, using :func:`~dockerfabric.parallel.execute_parallel`. Each host
+    pulls the images one after another. Instead of the progress of single layers, a summary over all hosts is printed.
+
+    :param images: Image names, optionally including a tag.
+    :type images: list[unicode]
+    :param hosts: Hosts to pull the images on. By default uses ``env.all_hosts`` or ``env.hosts``.
+    :type hosts: list[unicode]
+    :param pool_size: Maximum number of hosts pulling at the same time. By default uses ``env.docker_pull_pool_size``
+      or ``env.docker_parallel_pool_size``.
+    :type pool_size: int
+    :param registry_limits: Maximum number of pulls at the same time from each registry, or a dictionary with limits
+      per registry. By default uses ``env.docker_pull_registry_limits``; if not set, pulls are not limited per registry.
+    :type registry_limits: int | dict
+    :param progress_interval: Time in seconds between progress updates. By default uses
+      ``env.docker_pull_progress_interval`` or 2 seconds.
+    :type progress_interval: float
+    :return: Results per host, with :class:`HostPullStatistics` as result of successful hosts.
+    :rtype: dockerfabric.parallel.ParallelResults
+    """
+    if isinstance(images, six.string_types):
+        images = [images]
+    host_strings = hosts or env.get('all_hosts') or env.hosts
+    limits = RegistryLimits(registry_limits or env.get('docker_pull_registry_limits'))
+    progress = FleetPullProgress(float(progress_interval or env.get('docker_pull_progress_interval') or
+                                       DEFAULT_PROGRESS_INTERVAL))
+    progress.start(host_strings)
+    try:
+        return execute_parallel(_pull_images, images, progress, limits, hosts=host_strings,
+                                pool_size=pool_size or env.get('docker_pull_pool_size'))
+    finally:
+        progress.stop()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from fabric import state
+from fabric.api import env, settings
+from fabric.network import to_dict
+from fabric.task_utils import crawl
+from fabric.tasks import Task, WrappedCallableTask
+from fabric.utils import _AttributeDict
+import six
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+
+_local = threading.local()
+_env_lock = threading.Lock()
+_env_users = 0
+_DELETED = object()
+
+
+class ThreadLocalEnv(_AttributeDict):
+    """
+    Replaces the class of Fabric's ``env`` while tasks are run in threads. Threads that have been assigned an overlay
+    by :func:`host_env` keep their changes of ``env`` (e.g. through :func:`~fabric.context_managers.settings`) to
+    themselves; all other threads read and write the shared values as usual.
+    """
+    @staticmethod
+    def _overlay():
+        return getattr(_local, 'env', None)
+
+    def __getitem__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            value = overlay[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return super(ThreadLocalEnv, self).__getitem__(key)
+
+    def __setitem__(self, key, value):
+        overlay = self._overlay()
+        if overlay is not None:
+            overlay[key] = value
+        else:
+            super(ThreadLocalEnv, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        overlay = self._overlay()
+        if overlay is not None:
+            if key not in self:
+                raise KeyError(key)
+            overlay[key] = _DELETED
+        else:
+            super(ThreadLocalEnv, self).__delitem__(key)
+
+    def __contains__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            return overlay[key] is not _DELETED
+        return super(ThreadLocalEnv, self).__contains__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+@contextmanager
+def thread_local_env():
+    """
+    Context manager for making Fabric's ``env`` thread-aware, as described in :class:`ThreadLocalEnv`. Can be nested.
+    """
+    global _env_users
+    with _env_lock:
+        if not _env_users:
+            # _AttributeDict would store the attribute as a key.
+            object.__setattr__(env, '__class__', ThreadLocalEnv)
+        _env_users += 1
+    try:
+        yield
+    finally:
+        with _env_lock:
+            _env_users -= 1
+            if not _env_users:
+                object.__setattr__(env, '__class__', _AttributeDict)
+
+
+@contextmanager
+def host_env(host_string):
+    """
+    Context manager for setting the current host in the current thread only. Requires :func:`thread_local_env` to be
+    active.
+
+    :param host_string: Fabric host string.
+    :type host_string: unicode
+    """
+    _local.env = {}
+    try:
+        with settings(**to_dict(host_string)):
+            yield
+    finally:
+        _local.env = None
+
+
+class HostResult(object):
+    """
+    Outcome of running a task on one host.
+
+    :param host_string: Fabric host string.
+    :type host_string: unicode
+    :param result: Return value of the task.
+    :param exception: Exception raised by the task, if it has failed.
+    :type exception: BaseException
+    :param duration: Time in seconds the task was running.
+    :type duration: float
+    """
+    def __init__(self, host_string, result=None, exception=None, duration=0.0):
+        self.host_string = host_string
+        self.result = result
+        self.exception = exception
+        self.duration = duration
+
+    @property
+    def succeeded(self):
+        return self.exception is None
+
+    def __str__(self):
+        if self.succeeded:
+            return "{0}: succeeded in {1:.1f} s".format(self.host_string, self.duration)
+        if isinstance(self.exception, SystemExit):
+            # Fabric has already printed the reason.
+            message = "aborted"
+        else:
+            message = six.text_type(self.exception) or self.exception.__class__.__name__
+        return "{0}: failed after {1:.1f} s: {2}".format(self.host_string, self.duration, message)
+
+
+class ParallelResults(dict):
+    """
+    Results of :func:`execute_parallel`, as a dictionary of host strings and :class:`HostResult` objects.
+    """
+    @property
+    def succeeded(self):
+        """
+        Hosts where the task has been run successfully.
+
+        :rtype: list[unicode]
+        """
+        return [host for host, result in self.items() if result.succeeded]
+
+    @property
+    def failed(self):
+        """
+        Hosts where the task has failed.
+
+        :rtype: list[unicode]
+        """
+        return [host for host, result in self.items() if not result.succeeded]
+
+    def summary(self):
+        """
+        Returns a summary of all hosts, with the failed hosts last.
+
+        :rtype: unicode
+        """
+        lines = [six.text_type(self[host]) for host in sorted(self.succeeded)]
+        lines.extend(six.text_type(self[host]) for host in sorted(self.failed))
+        lines.append("{0} of {1} hosts succeeded.".format(len(self.succeeded), len(self)))
+        return '\n'.join(lines)
+
+
+def _get_task(task):
+    if isinstance(task, Task):
+        return task
+    if callable(task):
+        return WrappedCallableTask(task)
+    task_obj = crawl(task, state.commands)
+    if task_obj is None:
+        raise ValueError("{0!r} is not callable or a valid task name.".format(task))
+    return task_obj
+
+
+def execute_parallel(task, *args, **kwargs):
+    """
+    Runs a task on multiple hosts in threads of the current process, as opposed to Fabric's parallel mode which forks
+    a process per host. Tunnels, SSH connections, and Docker clients are therefore shared between tasks, and port
+    offsets for tunnels are not needed. Whereas each thread has its own copy of ``env`` (see :class:`ThreadLocalEnv`),
+    anything else used by the task has to be thread-safe.
+
+    Failures on single hosts do not abort the other hosts; they are included in the results.
+
+    :param task: Task object, callable, or task name.
+    :param args: Positional arguments to the task.
+    :param kwargs: Keyword arguments to the task. ``hosts`` sets the hosts to run on instead of ``env.all_hosts`` or
+      ``env.hosts``. ``pool_size`` limits the number of hosts processed at a time; by default uses
+      ``env.docker_parallel_pool_size`` or 10.
+    :return: Results per host.
+    :rtype: ParallelResults
+    """
+    task_obj = _get_task(task)
+    hosts = kwargs.pop('hosts', None) or env.get('all_hosts') or env.hosts
+    pool_size = int(kwargs.pop('pool_size', None) or env.get('docker_parallel_pool_size') or DEFAULT_POOL_SIZE)
+    results = ParallelResults()
+    host_queue = queue.Queue()
+    for host_string in hosts:
+        host_queue.put(host_string)
+
+    def _run_host(host_string):
+        start_ts = time.time()
+        try:
+            with host_env(host_string):
+                result = task_obj.run(*args, **kwargs)
+        except (Exception, SystemExit) as e:
+            # Fabric's abort() raises SystemExit.
+            log.debug("Task failed on host %s.", host_string, exc_info=True)
+            return HostResult(host_string, exception=e, duration=time.time() - start_ts)
+        return HostResult(host_string, result, duration=time.time() - start_ts)
+
+    def _worker():
+        while True:
+            try:
+                host_string = host_queue.get_nowait()
+            except queue.Empty:
+                return
+            results[host_string] = _run_host(host_string)
+
+    with thread_local_env():
+        workers = [threading.Thread(target=_worker, name='docker_parallel_{0}'.format(i))
+                   for i in range(min(pool_size, len(hosts)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt.
+            while worker.is_alive():
+                worker.join(1)
+    return results
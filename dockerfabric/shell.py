@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+import uuid
+
+from fabric.api import env, quiet as quiet_manager, settings
+from fabric.operations import _AttributeString, _prefix_commands, _prefix_env_vars, _sudo_prefix
+from fabric.state import output
+from fabric.utils import error, puts
+from six.moves import shlex_quote
+
+from .base import ConnectionDict
+from .tunnel import channel_schedulers
+
+log = logging.getLogger(__name__)
+
+RECV_BUFFER_SIZE = 65536
+
+
+class ShellError(Exception):
+    pass
+
+
+def _get_shell():
+    if not env.use_shell:
+        return '/bin/sh'
+    # The shell reads commands from its input instead of receiving them with -c.
+    shell = env.shell
+    if shell.endswith(' -c'):
+        return shell[:-3]
+    return shell
+
+
+class RemoteShell(object):
+    """
+    Keeps a shell open on a remote host for running commands one after another, instead of opening a new SSH channel
+    and starting a new shell for each of them. Output and exit code of each command are read up to a delimiter, which is
+    written after the command has finished. Each command runs in a subshell, so that changes to the working directory
+    or environment variables do not carry over. Standard error is merged into the output, and commands do not read
+    from standard input.
+
+    As with Fabric's ``run`` and ``sudo``, the shell is started as set in ``env.shell``, with a pseudo-terminal unless
+    ``env.always_use_pty`` is ``False``. The current settings of :func:`~fabric.context_managers.cd`,
+    :func:`~fabric.context_managers.prefix`, and :func:`~fabric.context_managers.shell_env` are applied to each
+    command. With `sudo`, the command line starts with ``env.sudo_prefix`` and switches to ``env.sudo_user`` if set;
+    these are read when the shell is created.
+
+    :param host_string: Fabric host string.
+    :type host_string: unicode
+    :param use_sudo: Start the shell through `sudo`. If a password is requested, ``env.sudo_password`` or
+      ``env.password`` is sent.
+    :type use_sudo: bool
+    :param timeout: Timeout in seconds for reading from the shell. By default no timeout is set.
+    :type timeout: float
+    :param shell: Shell command line. By default uses ``env.shell`` without the ``-c`` argument.
+    :type shell: unicode
+    :param pty: Request a pseudo-terminal. By default uses ``env.always_use_pty``.
+    :type pty: bool
+    """
+    def __init__(self, host_string, use_sudo=False, timeout=None, shell=None, pty=None):
+        self.host_string = host_string
+        self.use_sudo = use_sudo
+        self.timeout = timeout
+        self.shell = shell or _get_shell()
+        self.pty = env.get('always_use_pty', True) if pty is None else pty
+        self.sudo_prefix = env.sudo_prefix
+        self.sudo_user = env.sudo_user
+        self.channel = None
+        self._marker = 'DOCKERFABRIC_{0}'.format(uuid.uuid4().hex)
+        self._buffer = b''
+        self._lock = threading.Lock()
+
+    def _wait_for_sudo(self, ready_line):
+        prompt = '{0}_PASSWORD:'.format(self._marker).encode('utf-8')
+        stdout_data = stderr_data = b''
+        prompted = False
+        while ready_line not in stdout_data:
+            if self.channel.recv_stderr_ready():
+                stderr_data += self.channel.recv_stderr(RECV_BUFFER_SIZE)
+            elif self.channel.recv_ready():
+                stdout_data += self.channel.recv(RECV_BUFFER_SIZE)
+            elif self.channel.exit_status_ready():
+                raise ShellError("Failed to start shell on {0}: {1}".format(
+                    self.host_string, (stderr_data or stdout_data).decode('utf-8', 'replace').strip()))
+            else:
+                time.sleep(0.01)
+                continue
+            # With a pseudo-terminal, the prompt is part of the standard output.
+            if prompt in stderr_data or prompt in stdout_data:
+                password = env.get('sudo_password') or env.get('password')
+                if prompted or not password:
+                    raise ShellError("sudo authentication failed on {0}. For a password prompt, set "
+                                     "env.sudo_password.".format(self.host_string))
+                prompted = True
+                stderr_data = stderr_data.replace(prompt, b'')
+                stdout_data = stdout_data.replace(prompt, b'')
+                self.channel.sendall(password.encode('utf-8') + b'\n')
+        self._buffer = stdout_data.partition(ready_line)[2]
+
+    def open(self):
+        """
+        Opens the shell. Is called by :meth:`run` if the shell is not open yet.
+        """
+        ready = '{0}_READY'.format(self._marker)
+        channel = channel_schedulers[self.host_string].open_session()
+        channel.settimeout(self.timeout)
+        self.channel = channel
+        # Without a terminal on its standard error, the shell does not run interactively and prints no prompts.
+        start_cmd = 'echo {0}; exec {1} 2>/dev/null'.format(ready, self.shell)
+        try:
+            if self.pty:
+                channel.get_pty()
+                # In raw mode without echo, input and output are passed through unchanged.
+                start_cmd = 'stty raw -echo 2>/dev/null; {0}'.format(start_cmd)
+            start_cmd = '/bin/sh -c {0}'.format(shlex_quote(start_cmd))
+            if self.use_sudo:
+                with settings(sudo_prefix=self.sudo_prefix, sudo_prompt='{0}_PASSWORD:'.format(self._marker)):
+                    start_cmd = _sudo_prefix(self.sudo_user) + start_cmd
+                # The password is only sent if sudo asks for it; anything else written before would be read by sudo.
+                channel.exec_command(start_cmd)
+                self._wait_for_sudo('{0}\n'.format(ready).encode('utf-8'))
+            else:
+                channel.exec_command(start_cmd)
+                self._read_until('{0}\n'.format(ready).encode('utf-8'))
+            # Skips anything that the startup files of the shell have printed.
+            channel.sendall("printf '%s_STARTED\\n' {0}\n".format(self._marker).encode('utf-8'))
+            self._read_until('{0}_STARTED\n'.format(self._marker).encode('utf-8'))
+        except:
+            self.close()
+            raise
+        log.debug("Opened remote shell on %s.", self.host_string)
+
+    def _read_until(self, delimiter):
+        while True:
+            index = self._buffer.find(delimiter)
+            if index >= 0:
+                data = self._buffer[:index]
+                self._buffer = self._buffer[index + len(delimiter):]
+                return data
+            data = self.channel.recv(RECV_BUFFER_SIZE)
+            if not data:
+                self.close()
+                raise ShellError("Remote shell on {0} has been closed.".format(self.host_string))
+            self._buffer += data
+
+    def execute(self, cmd):
+        """
+        Runs a command in the shell.
+
+        :param cmd: Command line.
+        :type cmd: unicode
+        :return: Output and exit code of the command.
+        :rtype: (unicode, int)
+        """
+        with self._lock:
+            if self.channel is None:
+                self.open()
+            # Applies cd, prefix, and shell_env, like Fabric's run and sudo.
+            cmd = _prefix_env_vars(_prefix_commands(cmd, 'remote'))
+            try:
+                # A subshell keeps the remote shell alive if the command calls exit, and isolates changes to its state.
+                self.channel.sendall("( {0}\n) </dev/null 2>&1; printf '\\n{1} %d\\n' $?\n".format(
+                    cmd, self._marker).encode('utf-8'))
+                data = self._read_until('\n{0} '.format(self._marker).encode('utf-8'))
+                return_code = int(self._read_until(b'\n'))
+            except:
+                # Unread output would otherwise be taken as the result of the next command.
+                self.close()
+                raise
+        return data.decode('utf-8', 'replace'), return_code
+
+    def run(self, cmd, shell=False, quiet=False, warn_only=False):
+        """
+        Runs a command like Fabric's ``run`` or ``sudo`` and returns the result in the same format.
+
+        :param cmd: Command line.
+        :type cmd: unicode
+        :param shell: Has no effect; commands are always run in the shell.
+        :type shell: bool
+        :param quiet: Do not print anything, and do not abort on errors.
+        :type quiet: bool
+        :param warn_only: Do not abort on errors.
+        :type warn_only: bool
+        :return: Output of the command, with the attributes ``return_code``, ``failed``, and ``succeeded``.
+        """
+        which = 'sudo' if self.use_sudo else 'run'
+        with quiet_manager() if quiet else settings():
+            if output.running:
+                puts("[{0}] {1}: {2}".format(self.host_string, which, cmd), show_prefix=False)
+            data, return_code = self.execute(cmd)
+            result = _AttributeString(data.strip())
+            if output.stdout:
+                for line in result.splitlines():
+                    puts("[{0}] out: {1}".format(self.host_string, line), show_prefix=False)
+            result.command = cmd
+            result.return_code = return_code
+            result.failed = return_code not in env.get('ok_ret_codes', [0])
+            result.succeeded = not result.failed
+            result.stderr = ''
+            if result.failed and not (quiet or warn_only or env.warn_only):
+                error("{0}() received nonzero return code {1} while executing '{2}'!".format(which, return_code, cmd),
+                      stdout=result)
+        return result
+
+    def close(self):
+        """
+        Closes the shell.
+        """
+        channel, self.channel = self.channel, None
+        self._buffer = b''
+        if channel is not None:
+            channel.close()
+
+    @property
+    def is_open(self):
+        channel = self.channel
+        return channel is not None and not channel.closed and not channel.exit_status_ready()
+
+
+class RemoteShells(ConnectionDict):
+    """
+    Cache for remote shells per host, and whether they are run with `sudo`.
+    """
+    def __getitem__(self, item):
+        """
+        :param item: Tuple of Fabric host string and whether to use `sudo`.
+        :type item: (unicode, bool)
+        :return: Remote shell.
+        :rtype: RemoteShell
+        """
+        def _create_shell():
+            return RemoteShell(host_string, use_sudo, env.get('docker_shell_timeout'), shell, pty)
+
+        host_string, use_sudo = item
+        shell = _get_shell()
+        pty = env.get('always_use_pty', True)
+        # Separate shells are kept for different settings of how they are started.
+        key = host_string, use_sudo, shell, pty
+        if use_sudo:
+            key += env.sudo_prefix, env.sudo_user
+        return self.get_or_create_connection(key, _create_shell)
+
+    def check_connection(self, connection, idle_time):
+        return connection.channel is None or connection.is_open
+
+
+remote_shells = RemoteShells()
@@ -1,19 +1,31 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import logging
+import threading
+import time
+
 from fabric.state import env
 from fabric.utils import puts
+from six.moves import shlex_quote
+
+from .base import get_local_port
+from .tunnel import LocalTunnel, TunnelConnectionDict
 
-from .base import ConnectionDict, get_local_port
-from .tunnel import LocalTunnel
+log = logging.getLogger(__name__)
 
+RELAY_HOST = '127.0.0.1'
+RELAY_SCRIPT = ("{0} & p=$!; sleep 0.2; "
+                "if kill -0 $p 2>/dev/null; then echo $p; read _; kill $p; else wait $p; exit 1; fi")
 
-class SocketTunnels(ConnectionDict):
+
+class SocketTunnels(TunnelConnectionDict):
     """
     Cache for **socat** tunnels to the remote machine.
 
     Instantiation of :class:`SocketTunnel` can be configured with ``env.socat_quiet``, setting
-    the ``quiet`` keyword argument.
+    the ``quiet`` keyword argument. If ``env.socat_relay`` is set to ``True``, a single **socat** relay process is
+    used for all connections to the host, listening on ``env.socat_relay_port``.
     """
     def __getitem__(self, item):
         """
@@ -24,7 +36,7 @@ class SocketTunnels(ConnectionDict):
         """
         def _connect_socket_tunnel():
             local_port = get_local_port(init_local_port)
-            svc = SocketTunnel(remote_socket, local_port, env.get('socat_quiet', True))
+            svc = SocketTunnel(remote_socket, local_port, env.get('socat_quiet', True), get_relay_port())
             svc.connect()
             return svc
 
@@ -36,6 +48,92 @@ class SocketTunnels(ConnectionDict):
 socat_tunnels = SocketTunnels()
 
 
+def get_relay_port():
+    """
+    Returns the remote port for a :class:`SocatRelay`, if relays are enabled by ``env.socat_relay``. The port has to
+    be set explicitly in ``env.socat_relay_port``, and must not be used by any other process on the remote host,
+    including relays of other runs or for other sockets.
+
+    :return: Remote port number; ``None`` if no relay should be used.
+    :rtype: int
+    """
+    if not env.get('socat_relay'):
+        return None
+    relay_port = env.get('socat_relay_port')
+    if not relay_port:
+        raise ValueError("The remote port of the socat relay has to be set in env.socat_relay_port.")
+    return int(relay_port)
+
+
+class SocatRelay(object):
+    """
+    Long-lived **socat** process on the remote end, which listens on a TCP port of the loopback interface and forwards
+    every incoming connection to a Unix socket. The process is started through a session channel, and terminates as
+    soon as that channel is closed, including when the SSH connection is lost.
+
+    Note that while the relay is running, any local user on the remote machine can connect to the port, and thereby
+    access the socket with the permissions of the SSH user.
+
+    :param remote_socket: Unix socket to connect to on the remote machine.
+    :type remote_socket: unicode
+    :param port: Remote TCP port to listen on.
+    :type port: int
+    :param quiet: If set to ``False``, the **socat** command line will be written to `stdout`.
+    :type quiet: bool
+    """
+    def __init__(self, remote_socket, port, quiet=True):
+        self.remote_socket = remote_socket
+        self.port = port
+        self.quiet = quiet
+        self.pid = None
+        self._channel = None
+        self._socat_cmd = 'socat TCP-LISTEN:{0},bind={1},reuseaddr,fork UNIX-CONNECT:{2}'.format(
+            port, RELAY_HOST, shlex_quote(remote_socket))
+
+    def start(self, transport):
+        """
+        Starts the relay process and reads its process id.
+
+        :param transport: SSH transport.
+        :type transport: paramiko.transport.Transport
+        """
+        channel = transport.open_session()
+        if not self.quiet:
+            puts(self._socat_cmd)
+        channel.exec_command('sh -c {0}'.format(shlex_quote(RELAY_SCRIPT.format(self._socat_cmd))))
+        pid = channel.makefile('r').readline().strip()
+        if not pid:
+            message = channel.makefile_stderr('r').read()
+            channel.close()
+            raise Exception("Failed to start socat relay on the remote end: {0}".format(message))
+        self._channel = channel
+        self.pid = int(pid)
+        log.debug("Started socat relay with pid %s on port %s.", self.pid, self.port)
+
+    def stop(self, timeout=5):
+        """
+        Terminates the relay process by closing the input of its session channel.
+
+        :param timeout: Time in seconds to wait for the process to terminate.
+        :type timeout: float
+        """
+        channel = self._channel
+        if channel is None:
+            return
+        try:
+            if not channel.closed:
+                channel.shutdown_write()
+                end_ts = time.time() + timeout
+                while not channel.exit_status_ready() and time.time() < end_ts:
+                    time.sleep(0.05)
+                if not channel.exit_status_ready():
+                    log.warning("Socat relay with pid %s did not terminate in time.", self.pid)
+        finally:
+            channel.close()
+            self._channel = None
+            self.pid = None
+
+
 class SocketTunnel(LocalTunnel):
     """
     Establish a tunnel from the local machine to the SSH host and from there start a **socat** process for forwarding
@@ -47,15 +145,30 @@ class SocketTunnel(LocalTunnel):
     :type local_port: int
     :param quiet: If set to ``False``, the **socat** command line on the SSH channel will be written to `stdout`.
     :type quiet: bool
+    :param relay_port: If set, instead of starting **socat** for every connection, starts a single :class:`SocatRelay`
+      on this remote port when the first connection is made. Connections are then forwarded through regular
+      TCP channels.
+    :type relay_port: int
     """
-    def __init__(self, remote_socket, local_port, quiet=True):
+    def __init__(self, remote_socket, local_port, quiet=True, relay_port=None):
         dest = 'STDIO'
-        src = 'UNIX-CONNECT:{0}'.format(remote_socket)
+        src = 'UNIX-CONNECT:{0}'.format(shlex_quote(remote_socket))
         self.quiet = quiet
         self._socat_cmd = ' '.join(('socat', dest, src))
+        if relay_port:
+            self.relay = SocatRelay(remote_socket, relay_port, quiet)
+        else:
+            self.relay = None
+        self._relay_lock = threading.Lock()
         super(SocketTunnel, self).__init__(local_port)
 
     def get_channel(self, transport, remote_addr, local_peer):
+        if self.relay is not None:
+            with self._relay_lock:
+                if self.relay.pid is None:
+                    # The relay runs as long as its session, so it is bound to the main connection of the host.
+                    self.relay.start(self.transport)
+            return super(SocketTunnel, self).get_channel(transport, (RELAY_HOST, self.relay.port), local_peer)
         channel = transport.open_channel('session')
         if channel is None:
             raise Exception("Failed to open channel on the SSH server.")
@@ -63,3 +176,10 @@ class SocketTunnel(LocalTunnel):
             puts(self._socat_cmd)
         channel.exec_command(self._socat_cmd)
         return channel
+
+    def close(self):
+        try:
+            super(SocketTunnel, self).close()
+        finally:
+            if self.relay is not None:
+                self.relay.stop()
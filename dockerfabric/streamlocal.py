@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from fabric.state import env
+from paramiko import Channel, ChannelException, Message, SSHException
+from paramiko.common import (cMSG_CHANNEL_OPEN, OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED,
+                             OPEN_FAILED_UNKNOWN_CHANNEL_TYPE)
+
+from .base import get_local_port
+from .socat import SocketTunnel, get_relay_port
+from .tunnel import TunnelConnectionDict
+
+log = logging.getLogger(__name__)
+
+STREAMLOCAL_CHANNEL = 'direct-streamlocal@openssh.com'
+UNSUPPORTED_CODES = (OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED, OPEN_FAILED_UNKNOWN_CHANNEL_TYPE)
+
+_unsupported_hosts = set()
+
+
+def open_streamlocal_channel(transport, socket_path, timeout=None):
+    """
+    Opens a channel to a Unix socket on the remote end, using the OpenSSH extension ``direct-streamlocal``. Paramiko
+    only adds the payload for TCP forwarding to a channel request, so this follows the implementation of
+    :meth:`paramiko.transport.Transport.open_channel`.
+
+    :param transport: SSH transport.
+    :type transport: paramiko.transport.Transport
+    :param socket_path: Path to the Unix socket on the remote machine.
+    :type socket_path: unicode
+    :param timeout: Timeout in seconds for opening the channel. Default is 3600 seconds.
+    :type timeout: float
+    :return: New channel.
+    :rtype: paramiko.channel.Channel
+    :raise paramiko.ChannelException: If the server rejects the request.
+    """
+    if not transport.active:
+        raise SSHException("SSH session not active.")
+    timeout = 3600 if timeout is None else timeout
+    transport.lock.acquire()
+    try:
+        window_size = transport._sanitize_window_size(None)
+        max_packet_size = transport._sanitize_packet_size(None)
+        chanid = transport._next_channel()
+        m = Message()
+        m.add_byte(cMSG_CHANNEL_OPEN)
+        m.add_string(STREAMLOCAL_CHANNEL)
+        m.add_int(chanid)
+        m.add_int(window_size)
+        m.add_int(max_packet_size)
+        m.add_string(socket_path)
+        m.add_string('')  # Reserved.
+        m.add_int(0)  # Reserved.
+        chan = Channel(chanid)
+        transport._channels.put(chanid, chan)
+        transport.channel_events[chanid] = event = threading.Event()
+        transport.channels_seen[chanid] = True
+        chan._set_transport(transport)
+        chan._set_window(window_size, max_packet_size)
+    finally:
+        transport.lock.release()
+    transport._send_user_message(m)
+    start_ts = time.time()
+    while True:
+        event.wait(0.1)
+        if not transport.active:
+            raise transport.get_exception() or SSHException("Unable to open channel.")
+        if event.is_set():
+            break
+        elif start_ts + timeout < time.time():
+            raise SSHException("Timeout opening channel.")
+    chan = transport._channels.get(chanid)
+    if chan is not None:
+        return chan
+    raise transport.get_exception() or SSHException("Unable to open channel.")
+
+
+class StreamLocalTunnels(TunnelConnectionDict):
+    """
+    Cache for tunnels to Unix sockets on the remote machine, which are forwarded directly by the SSH server.
+    """
+    def __getitem__(self, item):
+        """
+        :param item: Tuple of remote socket name and local port number.
+        :type item: tuple
+        :return: Stream-local tunnel
+        :rtype: StreamLocalTunnel
+        """
+        def _connect_streamlocal_tunnel():
+            local_port = get_local_port(init_local_port)
+            svc = StreamLocalTunnel(remote_socket, local_port, env.get('socat_quiet', True), get_relay_port())
+            svc.connect()
+            return svc
+
+        remote_socket, init_local_port = item
+        key = env.host_string, remote_socket
+        return self.get_or_create_connection(key, _connect_streamlocal_tunnel)
+
+
+streamlocal_tunnels = StreamLocalTunnels()
+
+
+class StreamLocalTunnel(SocketTunnel):
+    """
+    Establish a tunnel from the local machine to a Unix socket on the SSH host. Channels are opened with the OpenSSH
+    extension ``direct-streamlocal``, so that no process has to be started on the remote end for each connection. If
+    the server does not support this (e.g. it is not OpenSSH 6.7 or later, or ``AllowStreamLocalForwarding`` is
+    disabled), falls back to starting **socat** as :class:`~dockerfabric.socat.SocketTunnel` does. The outcome is
+    remembered for the host.
+
+    :param remote_socket: Unix socket to connect to on the remote machine.
+    :type remote_socket: unicode
+    :param local_port: Local TCP port to use for the tunnel.
+    :type local_port: int
+    :param quiet: If set to ``False``, the **socat** command line on the SSH channel will be written to `stdout`, in
+      case it is used as a fallback.
+    :type quiet: bool
+    :param relay_port: Remote port for a :class:`~dockerfabric.socat.SocatRelay`, in case **socat** is used as a
+      fallback.
+    :type relay_port: int
+    """
+    def __init__(self, remote_socket, local_port, quiet=True, relay_port=None):
+        super(StreamLocalTunnel, self).__init__(remote_socket, local_port, quiet, relay_port)
+        self.remote_socket = remote_socket
+        self.host_string = env.host_string
+
+    def get_channel(self, transport, remote_addr, local_peer):
+        if self.host_string not in _unsupported_hosts:
+            try:
+                return open_streamlocal_channel(transport, self.remote_socket)
+            except ChannelException as e:
+                if e.code not in UNSUPPORTED_CODES:
+                    raise
+                log.info("Host %s does not support direct-streamlocal channels (%s); falling back to socat.",
+                         self.host_string, e)
+                _unsupported_hosts.add(self.host_string)
+        return super(StreamLocalTunnel, self).get_channel(transport, remote_addr, local_peer)
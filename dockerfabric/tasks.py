@@ -3,21 +3,39 @@ from __future__ import unicode_literals
 
 from datetime import datetime
 import itertools
+import os
 from fabric.api import env, run, runs_once, sudo, task
-from fabric.utils import puts, fastprint
+from fabric.utils import error, puts, fastprint
 import six
 
 from dockermap.utils import expand_path
 from . import cli
+from .agent import CMD_STATUS, CMD_STOP, TunnelAgent, agent_request, get_agent_socket
 from .api import docker_fabric
+from .apiclient import get_tunnel_url
+from .fleet import fleet_pull
+from .parallel import execute_parallel
+from .socat import socat_tunnels
+from .streamlocal import streamlocal_tunnels
+from .tunnel import channel_schedulers, local_tunnels
 from .utils.net import get_ip4_address, get_ip6_address
 from .utils.output import stdout_result
+from .utils.streams import (COMPRESSION_GZIP, COMPRESSION_ZSTD, TransferProgress, decompress_chunks, detect_compression,
+                            read_chunks)
 
 
 IMAGE_COLUMNS = ('Id', 'RepoTags', 'ParentId', 'Created', 'VirtualSize', 'Size')
 CONTAINER_COLUMNS = ('Id', 'Names', 'Image', 'Command', 'Ports', 'Status', 'Created')
 NETWORK_COLUMNS = ('Id', 'Name', 'Driver', 'Scope')
 VOLUME_COLUMNS = ('Name', 'Driver')
+TRANSFER_API = 'api'
+TRANSFER_SSH = 'ssh'
+
+
+def _get_archive_compression(compression):
+    if not compression or compression == 'none':
+        return None
+    return compression
 
 
 def _format_output_table(data_dict, columns, full_ids=False, full_cmd=False, short_image=False):
@@ -75,6 +93,180 @@ def reset_socat(use_sudo=False):
     which('kill {0}'.format(' '.join(pids)), quiet=True)
 
 
+@task
+def tunnel_statistics():
+    """
+    Shows the amount of data transferred through the tunnels opened in the current process, and the transfer rates.
+    """
+    for tunnels in (local_tunnels, socat_tunnels, streamlocal_tunnels):
+        for key, tunnel in six.iteritems(tunnels):
+            puts('{0}: {1}'.format(':'.join(map(six.text_type, key)), tunnel.statistics))
+            if tunnel.channel_pool is not None:
+                puts('{0}: {1}'.format(':'.join(map(six.text_type, key)), tunnel.channel_pool))
+    for host_string, scheduler in six.iteritems(channel_schedulers):
+        puts('{0}: {1}'.format(host_string, scheduler))
+
+
+@task
+@runs_once
+def start_agent(daemon=True):
+    """
+    Starts a tunnel agent, which keeps SSH connections and tunnels to Docker services open for subsequent Fabric runs.
+    Clients use the agent while it is running. It has to be able to authenticate without prompting, e.g. with keys.
+
+    :param daemon: Run the agent in the background. If set to ``False``, it runs until interrupted.
+    :type daemon: bool
+    """
+    agent = TunnelAgent(get_tunnel_url)
+    if daemon:
+        pid = agent.start_daemon()
+        puts("Started tunnel agent with pid {0} on {1}.".format(pid, agent.socket_path))
+    else:
+        agent.serve()
+
+
+@task
+@runs_once
+def agent_status():
+    """
+    Shows the tunnels held open by the tunnel agent.
+    """
+    response = agent_request(CMD_STATUS)
+    puts("Tunnel agent on {0}:".format(get_agent_socket()))
+    for tunnel in response['tunnels']:
+        puts(tunnel)
+
+
+@task
+@runs_once
+def stop_agent():
+    """
+    Stops the tunnel agent and closes its tunnels.
+    """
+    agent_request(CMD_STOP)
+    puts("Stopped tunnel agent on {0}.".format(get_agent_socket()))
+
+
+@task
+@runs_once
+def run_parallel(task_name, *args, **kwargs):
+    """
+    Runs a task on all hosts in threads, sharing tunnels and clients. Prints a summary of the results.
+
+    :param task_name: Name of the task.
+    :type task_name: unicode
+    :param args: Positional arguments to the task.
+    :param kwargs: Keyword arguments to the task. ``pool_size`` sets the number of hosts processed at a time.
+    """
+    results = execute_parallel(task_name, *args, **kwargs)
+    puts(results.summary())
+    if results.failed:
+        error("Task '{0}' failed on {1} host(s).".format(task_name, len(results.failed)))
+
+
+@task
+@runs_once
+def pull_images_parallel(*images, **kwargs):
+    """
+    Pulls images on all hosts at the same time. Prints the overall progress, and the time and downloaded data per host.
+
+    :param images: Image names, optionally including a tag. Note that on the command line, colons have to be escaped,
+      e.g. ``pull_images_parallel:nginx\\:latest``.
+    :type images: unicode
+    :param kwargs: ``pool_size`` sets the number of hosts pulling at a time, ``registry_limit`` the number of pulls at a
+      time from the same registry.
+    """
+    registry_limit = kwargs.get('registry_limit')
+    results = fleet_pull(images, pool_size=kwargs.get('pool_size'),
+                         registry_limits=int(registry_limit) if registry_limit else None)
+    for host_string in sorted(results.succeeded):
+        puts('{0}: {1}'.format(host_string, results[host_string].result))
+    for host_string in sorted(results.failed):
+        puts(results[host_string])
+    if results.failed:
+        error("Pulling images failed on {0} host(s).".format(len(results.failed)))
+
+
+@task
+@runs_once
+def distribute_image(image, relay=False, fan_out=True):
+    """
+    Copies an image from the first host to all other hosts, by streaming ``docker save`` into ``docker load``. By
+    default, hosts transfer the image among each other through SSH, with every host that has received the image
+    passing it on to another one. With ``relay``, the image is transferred through the local machine instead.
+
+    :param image: Image name or id.
+    :type image: unicode
+    :param relay: Transfer the image through the local machine.
+    :type relay: bool
+    :param fan_out: Use hosts that have received the image as additional sources.
+    :type fan_out: bool
+    """
+    hosts = env.get('all_hosts') or env.hosts
+    results = cli.distribute_image(image, hosts[0], hosts[1:], fan_out=fan_out, relay=relay)
+    for host_string in sorted(results):
+        result = results[host_string]
+        if result.succeeded:
+            puts("{0}: received from {1} in {2:.1f} s".format(host_string, result.result, result.duration))
+        else:
+            puts(result)
+    if results.failed:
+        error("Distributing image '{0}' failed on {1} host(s).".format(image, len(results.failed)))
+
+
+@task
+@runs_once
+def sync_image(image, relay=False):
+    """
+    Copies an image from the first host to all other hosts, but only transfers the layers that each host is missing.
+
+    :param image: Image name or id.
+    :type image: unicode
+    :param relay: Transfer the layers through the local machine.
+    :type relay: bool
+    """
+    hosts = env.get('all_hosts') or env.hosts
+    results = cli.sync_image(image, hosts[0], hosts[1:], relay=relay)
+    for host_string in sorted(results):
+        result = results[host_string]
+        if result.succeeded:
+            info = result.result
+            puts("{0}: transferred {1} of {2} layers ({3} bytes) in {4:.1f} s".format(
+                host_string, info.transferred_layers, info.layers, info.transferred_bytes, result.duration))
+        else:
+            puts(result)
+    if results.failed:
+        error("Synchronizing image '{0}' failed on {1} host(s).".format(image, len(results.failed)))
+
+
+@task
+def put_resource(container, local_path, container_path, apply_chown=None, apply_chmod=None, method=None):
+    """
+    Uploads a local file or directory into a container. The archive is generated while it is sent, without a temporary
+    file.
+
+    :param container: Container name or id.
+    :type container: unicode
+    :param local_path: Local file or directory. Contents of a directory are placed in ``container_path``.
+    :type local_path: unicode
+    :param container_path: Existing directory in the container.
+    :type container_path: unicode
+    :param apply_chown: Owner to set for the uploaded files, as numeric ids in the notation ``user:group``.
+    :type apply_chown: unicode
+    :param apply_chmod: Permissions to set for the uploaded files, in octal notation.
+    :type apply_chmod: unicode
+    :param method: Use ``api`` (default) or ``ssh`` (``docker cp``) for the upload.
+    :type method: unicode
+    """
+    path = expand_path(local_path)
+    if method == TRANSFER_SSH:
+        cli.put_resource(container, path, container_path, apply_chown, apply_chmod)
+    elif not method or method == TRANSFER_API:
+        docker_fabric().put_resource(container, path, container_path, apply_chown, apply_chmod)
+    else:
+        error("Invalid upload method '{0}'.".format(method))
+
+
 @task
 def version():
     """
@@ -211,37 +403,72 @@ def remove_all_containers(**kwargs):
 
 @task
 @runs_once
-def save_image(image, filename=None):
+def save_image(image, filename=None, compression=COMPRESSION_GZIP):
     """
     Saves a Docker image from the remote to a local files. For performance reasons, uses the Docker command line client
-    on the host, generates a gzip-tarball and downloads that.
+    on the host, and streams the tarball to the local file. It is compressed on the host if `pigz` or `zstd` is
+    available there, and locally otherwise.
 
     :param image: Image name or id.
     :type image: unicode
     :param filename: File name to store the local file. If not provided, will use ``<image>.tar.gz`` in the current
       working directory.
     :type filename: unicode
+    :param compression: ``gzip``, ``zstd``, or ``none``.
+    :type compression: unicode
+    """
+    archive_compression = _get_archive_compression(compression)
+    local_name = filename or '{0}{1}'.format(image, cli.ARCHIVE_EXTENSIONS[archive_compression])
+    cli.save_image(image, local_name, compression=archive_compression)
+
+
+@task
+@runs_once
+def save_images(filename, *images, **kwargs):
+    """
+    Saves multiple Docker images from the remote into one local file. Layers that the images have in common are only
+    stored once.
+
+    :param filename: File name to store the local file.
+    :type filename: unicode
+    :param images: Image names or ids.
+    :type images: unicode
+    :param kwargs: ``compression`` can be ``gzip`` (default), ``zstd``, or ``none``.
     """
-    local_name = filename or '{0}.tar.gz'.format(image)
-    cli.save_image(image, local_name)
+    archive_compression = _get_archive_compression(kwargs.get('compression', COMPRESSION_GZIP))
+    cli.save_images(images, filename, compression=archive_compression)
 
 
 @task
-def load_image(filename, timeout=120):
+def load_image(filename, timeout=120, method=None):
     """
-    Uploads an image from a local file to a Docker remote. Note that this temporarily has to extend the service timeout
-    period.
+    Uploads an image from a local file to a Docker remote. The file is read in chunks and can be compressed with gzip
+    or zstd. Files compressed with zstd are by default sent through an SSH channel to ``docker load`` on the remote
+    host, where they are decompressed; other files are uploaded through the API.
 
     :param filename: Local file name.
     :type filename: unicode
-    :param timeout: Timeout in seconds to set temporarily for the upload.
+    :param timeout: Timeout in seconds for the upload through the API.
     :type timeout: int
+    :param method: Use ``api`` or ``ssh`` for the upload. By default uses ``env.docker_load_method``, or the method
+      depending on the compression as described above.
+    :type method: unicode
     """
-    c = docker_fabric()
-    with open(expand_path(filename), 'r') as f:
-        _timeout = c._timeout
-        c._timeout = timeout
-        try:
-            c.load_image(f)
-        finally:
-            c._timeout = _timeout
+    local_name = expand_path(filename)
+    compression = detect_compression(local_name)
+    load_method = method or env.get('docker_load_method')
+    if not load_method:
+        load_method = TRANSFER_SSH if compression == COMPRESSION_ZSTD else TRANSFER_API
+    if load_method == TRANSFER_SSH:
+        cli.load_image(local_name, compression)
+        return
+    elif load_method != TRANSFER_API:
+        error("Invalid load method '{0}'.".format(load_method))
+    progress = TransferProgress("Loading image", os.path.getsize(local_name))
+    with open(local_name, 'rb') as f:
+        chunks = read_chunks(f, progress=progress)
+        if compression == COMPRESSION_ZSTD:
+            # The Docker service decompresses gzip itself.
+            chunks = decompress_chunks(chunks, compression)
+        docker_fabric().load_image(chunks, timeout=float(timeout))
+    progress.finish()
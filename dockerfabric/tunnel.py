@@ -1,18 +1,54 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from collections import deque
+import errno
+import logging
+import os
 import select
+import shutil
 import socket
-import errno
+import tempfile
+import threading
+import time
 
-from fabric.network import needs_host
+from fabric.network import connect, needs_host, normalize
 from fabric.state import connections, env
 from fabric.thread_handling import ThreadHandler
+from paramiko import ChannelException, SSHException
+from paramiko.common import OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED, OPEN_FAILED_RESOURCE_SHORTAGE
 
 from .base import ConnectionDict, get_local_port
 
+try:
+    import selectors
+except ImportError:
+    try:
+        import selectors34 as selectors
+    except ImportError:
+        selectors = None
+
+log = logging.getLogger(__name__)
 
-class LocalTunnels(ConnectionDict):
+ENGINE_THREAD = 'thread'
+ENGINE_SELECTOR = 'selector'
+DEFAULT_BUFFER_SIZE = 65536
+# While a channel cannot take more data, the forwarding loop checks it at this interval in seconds.
+CHANNEL_POLL_INTERVAL = 0.01
+WOULD_BLOCK_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK)
+# OpenSSH rejects sessions beyond MaxSessions as administratively prohibited.
+RETRY_CODES = (OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED, OPEN_FAILED_RESOURCE_SHORTAGE)
+
+
+class TunnelConnectionDict(ConnectionDict):
+    """
+    Cache for tunnels. Replaces tunnels that have been closed or whose SSH connection has been lost.
+    """
+    def check_connection(self, connection, idle_time):
+        return connection.is_alive()
+
+
+class LocalTunnels(TunnelConnectionDict):
     """
     Cache for local tunnels to the remote machine.
     """
@@ -30,46 +66,803 @@ class LocalTunnels(ConnectionDict):
             return tun
 
         remote_host, remote_port, bind_host, init_bind_port = item
-        key = remote_host, remote_port
+        key = env.host_string, remote_host, remote_port
         return self.get_or_create_connection(key, _connect_local_tunnel)
 
 
 local_tunnels = LocalTunnels()
 
 
-def _forwarder(chan, sock):
+def _close_quietly(obj):
+    try:
+        obj.close()
+    except socket.error:
+        pass
+
+
+def _forward_data(src, dest, view, size, count):
+    # Sockets read into the reusable buffer. Paramiko channels allocate a new byte string on every read.
+    if isinstance(src, socket.socket):
+        data = view[:src.recv_into(view, size)]
+    else:
+        data = memoryview(src.recv(size))
+    length = len(data)
+    if length:
+        if isinstance(dest, socket.socket):
+            # Partial writes continue from the memoryview, without copying the remaining data.
+            while data:
+                data = data[dest.send(data):]
+        else:
+            # Channels only accept byte strings, which they copy into the SSH packet anyway.
+            data = data.tobytes()
+            while data:
+                sent = dest.send(data)
+                if not sent:
+                    raise socket.error(errno.EPIPE, "Channel has been closed.")
+                data = data[sent:]
+        count(length)
+    return length
+
+
+class TunnelStatistics(object):
+    """
+    Counts the connections and data transferred through a tunnel. Rates refer to the period between the first and the
+    last transfer.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.first_transfer = None
+        self.last_transfer = None
+        self.total_connections = 0
+        self.active_connections = 0
+
+    def connection_opened(self):
+        """
+        Counts a new connection.
+        """
+        with self._lock:
+            self.total_connections += 1
+            self.active_connections += 1
+
+    def connection_closed(self):
+        """
+        Counts a finished connection.
+        """
+        with self._lock:
+            self.active_connections -= 1
+
+    def _add(self, attr, length):
+        now = time.time()
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + length)
+            if self.first_transfer is None:
+                self.first_transfer = now
+            self.last_transfer = now
+
+    def add_sent(self, length):
+        """
+        Adds to the number of bytes sent from the local end to the remote.
+
+        :param length: Number of bytes.
+        :type length: int
+        """
+        self._add('bytes_sent', length)
+
+    def add_received(self, length):
+        """
+        Adds to the number of bytes received from the remote end.
+
+        :param length: Number of bytes.
+        :type length: int
+        """
+        self._add('bytes_received', length)
+
+    @property
+    def duration(self):
+        """
+        Time in seconds between the first and the last transfer.
+
+        :rtype: float
+        """
+        if self.first_transfer is None:
+            return 0.0
+        return self.last_transfer - self.first_transfer
+
+    def _rate(self, length):
+        duration = self.duration
+        if duration > 0:
+            return length / duration
+        return 0.0
+
+    @property
+    def send_rate(self):
+        """
+        Bytes per second sent to the remote end.
+
+        :rtype: float
+        """
+        return self._rate(self.bytes_sent)
+
+    @property
+    def receive_rate(self):
+        """
+        Bytes per second received from the remote end.
+
+        :rtype: float
+        """
+        return self._rate(self.bytes_received)
+
+    def __str__(self):
+        return ("{0} active / {1} total connections, sent {2} bytes ({3:.1f} KiB/s), "
+                "received {4} bytes ({5:.1f} KiB/s)").format(
+            self.active_connections, self.total_connections, self.bytes_sent, self.send_rate / 1024,
+            self.bytes_received, self.receive_rate / 1024)
+
+
+def _forwarder(chan, sock, buffer_size, statistics):
     # Bidirectionally forward data between a socket and a Paramiko channel.
+    view = memoryview(bytearray(buffer_size))
     try:
         while True:
             r, w, x = select.select([sock, chan], [], [], 1)
             if sock in r:
-                data = sock.recv(1024)
-                if len(data) == 0:
+                if not _forward_data(sock, chan, view, buffer_size, statistics.add_sent):
                     break
-                chan.sendall(data)
             if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
+                if not _forward_data(chan, sock, view, buffer_size, statistics.add_received):
                     break
-                sock.sendall(data)
     except socket.error as e:
         #Sockets return bad file descriptor if closed.
         #Maybe there is a cleaner way of doing this?
-        if e.errno not in (socket.EBADF, errno.ECONNRESET):
+        if e.errno not in (socket.EBADF, errno.ECONNRESET, errno.EPIPE):
             raise
     except select.error as e:
         if e[0] != socket.EBADF:
             raise
 
-    try:
-        chan.close()
-    except socket.error:
-        pass
+    _close_quietly(chan)
+    _close_quietly(sock)
 
-    try:
-        sock.close()
-    except socket.error:
-        pass
+
+class ThreadForwarder(object):
+    """
+    Forwards data between a socket and a Paramiko channel in a separate thread.
+
+    :param chan: Paramiko channel.
+    :type chan: paramiko.channel.Channel
+    :param sock: Local socket.
+    :type sock: socket.socket
+    :param buffer_size: Size of the buffer for reading and writing data.
+    :type buffer_size: int
+    :param statistics: Statistics object for counting transferred data.
+    :type statistics: TunnelStatistics
+    :param on_finish: Optional callback with the forwarder as argument, called when forwarding has ended.
+    :type on_finish: callable
+    """
+    def __init__(self, chan, sock, buffer_size=DEFAULT_BUFFER_SIZE, statistics=None, on_finish=None):
+        self.channel = chan
+        self.socket = sock
+        self.on_finish = on_finish
+        self.handler = ThreadHandler('fwd', self._run, buffer_size, statistics or TunnelStatistics())
+
+    def _run(self, buffer_size, statistics):
+        try:
+            _forwarder(self.channel, self.socket, buffer_size, statistics)
+        except Exception:
+            log.exception("Unexpected error while forwarding data.")
+            raise
+        finally:
+            if self.on_finish is not None:
+                self.on_finish(self)
+
+    def is_alive(self):
+        return self.handler.thread.is_alive()
+
+    def close(self):
+        self.socket.close()
+        if not self.channel.closed:
+            self.channel.close()
+        self.handler.thread.join()
+        self.handler.raise_if_needed()
+
+
+class SelectorForwarder(object):
+    """
+    Forwards data between a socket and a Paramiko channel as part of a :class:`ForwardingLoop`.
+
+    :param loop: Forwarding loop that this connection is registered on.
+    :type loop: ForwardingLoop
+    :param chan: Paramiko channel.
+    :type chan: paramiko.channel.Channel
+    :param sock: Local socket.
+    :type sock: socket.socket
+    :param buffer_size: Maximum size of data to read and write at once.
+    :type buffer_size: int
+    :param statistics: Statistics object for counting transferred data.
+    :type statistics: TunnelStatistics
+    :param on_finish: Optional callback with the forwarder as argument, called when forwarding has ended.
+    :type on_finish: callable
+    """
+    def __init__(self, loop, chan, sock, buffer_size=DEFAULT_BUFFER_SIZE, statistics=None, on_finish=None):
+        self.loop = loop
+        self.channel = chan
+        self.socket = sock
+        self.buffer_size = buffer_size
+        self.statistics = statistics or TunnelStatistics()
+        self.on_finish = on_finish
+        self.finished = threading.Event()
+        # Data that has been read, but not yet been completely written to the other side.
+        self.to_channel = None
+        self.to_socket = None
+
+    def is_alive(self):
+        return not self.finished.is_set()
+
+    def close(self, timeout=5):
+        if not self.finished.is_set():
+            self.loop.remove(self)
+            self.finished.wait(timeout)
+
+
+class ForwardingLoop(object):
+    """
+    Moves data between local sockets and Paramiko channels of all tunnels in a single thread. Uses the most efficient
+    selector implementation available on the platform, e.g. `epoll` on Linux. Since data is only moved in one thread,
+    all connections share the same buffer for reading from sockets.
+
+    Sockets and channels do not block. If one side of a connection cannot take all data at once, the rest is kept for
+    that direction, and the other side is not read from until it has been written. This way, a slow peer only holds up
+    its own connection.
+
+    :param select_timeout: Maximum time in seconds to wait for events in one iteration.
+    :type select_timeout: float
+    """
+    def __init__(self, select_timeout=1):
+        if selectors is None:
+            raise ValueError("The selector forwarding engine requires the module 'selectors' (Python 3.4 or later), "
+                             "or its backport 'selectors34'.")
+        self.select_timeout = select_timeout
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._added = []
+        self._removed = []
+        self._thread = None
+        self._pending_channels = set()
+        self._buffer = memoryview(bytearray(DEFAULT_BUFFER_SIZE))
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except socket.error:
+            pass
+
+    def add(self, chan, sock, buffer_size=DEFAULT_BUFFER_SIZE, statistics=None, on_finish=None):
+        """
+        Registers a new pair of socket and channel for forwarding data.
+
+        :param chan: Paramiko channel.
+        :type chan: paramiko.channel.Channel
+        :param sock: Local socket.
+        :type sock: socket.socket
+        :param buffer_size: Maximum size of data to read and write at once.
+        :type buffer_size: int
+        :param statistics: Statistics object for counting transferred data.
+        :type statistics: TunnelStatistics
+        :param on_finish: Optional callback with the forwarder as argument, called when forwarding has ended.
+        :type on_finish: callable
+        :return: Forwarder object.
+        :rtype: SelectorForwarder
+        """
+        forwarder = SelectorForwarder(self, chan, sock, buffer_size, statistics, on_finish)
+        with self._lock:
+            if len(self._buffer) < buffer_size:
+                self._buffer = memoryview(bytearray(buffer_size))
+            self._added.append(forwarder)
+            if self._thread is None or not self._thread.thread.is_alive():
+                self._thread = ThreadHandler('fwd_loop', self._run)
+        self._wakeup()
+        return forwarder
+
+    def remove(self, forwarder):
+        """
+        Closes the socket and channel of a forwarder, and removes them from the loop.
+
+        :param forwarder: Forwarder object, as returned by :meth:`add`.
+        :type forwarder: SelectorForwarder
+        """
+        with self._lock:
+            self._removed.append(forwarder)
+        self._wakeup()
+
+    def _set_events(self, obj, events, forwarder):
+        try:
+            key = self._selector.get_key(obj)
+        except (KeyError, ValueError):
+            key = None
+        if key is None:
+            if events:
+                self._selector.register(obj, events, forwarder)
+        elif not events:
+            self._selector.unregister(obj)
+        elif key.events != events:
+            self._selector.modify(obj, events, forwarder)
+
+    def _update_events(self, forwarder):
+        socket_events = ((selectors.EVENT_READ if forwarder.to_channel is None else 0) |
+                         (selectors.EVENT_WRITE if forwarder.to_socket is not None else 0))
+        channel_events = selectors.EVENT_READ if forwarder.to_socket is None else 0
+        self._set_events(forwarder.socket, socket_events, forwarder)
+        self._set_events(forwarder.channel, channel_events, forwarder)
+
+    def _register(self, forwarder):
+        try:
+            forwarder.socket.setblocking(False)
+            forwarder.channel.setblocking(False)
+            self._update_events(forwarder)
+        except (ValueError, KeyError, socket.error):
+            log.exception("Failed to register connection for forwarding.")
+            self._unregister(forwarder)
+
+    def _unregister(self, forwarder):
+        if forwarder.finished.is_set():
+            return
+        self._pending_channels.discard(forwarder)
+        for obj in (forwarder.socket, forwarder.channel):
+            try:
+                self._selector.unregister(obj)
+            except (ValueError, KeyError, socket.error):
+                pass
+            _close_quietly(obj)
+        forwarder.to_channel = forwarder.to_socket = None
+        forwarder.finished.set()
+        if forwarder.on_finish is not None:
+            try:
+                forwarder.on_finish(forwarder)
+            except Exception:
+                log.exception("Error in forwarder callback.")
+
+    def _update(self):
+        with self._lock:
+            added, self._added = self._added, []
+            removed, self._removed = self._removed, []
+            buf = self._buffer
+        for forwarder in added:
+            self._register(forwarder)
+        for forwarder in removed:
+            self._unregister(forwarder)
+        return buf
+
+    def _read_socket(self, forwarder, buf):
+        try:
+            length = forwarder.socket.recv_into(buf, forwarder.buffer_size)
+        except socket.error as e:
+            if e.errno in WOULD_BLOCK_ERRORS:
+                return
+            raise
+        if not length:
+            self._unregister(forwarder)
+            return
+        forwarder.statistics.add_sent(length)
+        # Paramiko channels only accept byte strings, which they copy into the SSH packet anyway.
+        forwarder.to_channel = buf[:length].tobytes()
+        self._write_channel(forwarder)
+
+    def _write_channel(self, forwarder):
+        data = forwarder.to_channel
+        try:
+            sent = forwarder.channel.send(data)
+        except socket.timeout:
+            sent = None
+        if sent == 0:
+            # The channel has been closed.
+            self._unregister(forwarder)
+            return
+        if sent is None or sent < len(data):
+            if sent:
+                forwarder.to_channel = data[sent:]
+            self._pending_channels.add(forwarder)
+        else:
+            forwarder.to_channel = None
+            self._pending_channels.discard(forwarder)
+        self._update_events(forwarder)
+
+    def _read_channel(self, forwarder):
+        try:
+            data = forwarder.channel.recv(forwarder.buffer_size)
+        except socket.timeout:
+            return
+        if not data:
+            self._unregister(forwarder)
+            return
+        forwarder.statistics.add_received(len(data))
+        forwarder.to_socket = memoryview(data)
+        self._write_socket(forwarder)
+
+    def _write_socket(self, forwarder):
+        data = forwarder.to_socket
+        try:
+            sent = forwarder.socket.send(data)
+        except socket.error as e:
+            if e.errno not in WOULD_BLOCK_ERRORS:
+                raise
+            sent = 0
+        # Slicing the memoryview does not copy the remaining data.
+        forwarder.to_socket = data[sent:] if sent < len(data) else None
+        self._update_events(forwarder)
+
+    def _handle_error(self, forwarder, e):
+        if e.errno not in (errno.EBADF, errno.ECONNRESET, errno.EPIPE) and not forwarder.channel.closed:
+            log.exception("Unexpected error while forwarding data.")
+        self._unregister(forwarder)
+
+    def _run(self):
+        while True:
+            buf = self._update()
+            timeout = CHANNEL_POLL_INTERVAL if self._pending_channels else self.select_timeout
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_recv:
+                    try:
+                        while self._wakeup_recv.recv(1024):
+                            pass
+                    except socket.error:
+                        pass
+                    continue
+                forwarder = key.data
+                try:
+                    if key.fileobj is forwarder.channel:
+                        if not forwarder.finished.is_set() and forwarder.to_socket is None:
+                            self._read_channel(forwarder)
+                        continue
+                    if mask & selectors.EVENT_WRITE and not forwarder.finished.is_set():
+                        self._write_socket(forwarder)
+                    if (mask & selectors.EVENT_READ and not forwarder.finished.is_set() and
+                            forwarder.to_channel is None):
+                        self._read_socket(forwarder, buf)
+                except socket.error as e:
+                    self._handle_error(forwarder, e)
+            for forwarder in list(self._pending_channels):
+                if forwarder.channel.send_ready():
+                    try:
+                        self._write_channel(forwarder)
+                    except socket.error as e:
+                        self._handle_error(forwarder, e)
+
+
+_loop_lock = threading.Lock()
+_forwarding_loop = None
+
+
+def get_forwarding_loop():
+    """
+    Returns the forwarding loop of the current process, and creates it if necessary.
+
+    :return: Forwarding loop.
+    :rtype: ForwardingLoop
+    """
+    global _forwarding_loop
+    with _loop_lock:
+        if _forwarding_loop is None:
+            _forwarding_loop = ForwardingLoop()
+        return _forwarding_loop
+
+
+class ChannelPool(object):
+    """
+    Keeps a number of channels opened ahead of demand, so that new connections on a tunnel do not have to wait for the
+    SSH server's response. Channels that are taken from the pool are replaced in a background thread.
+
+    :param open_channel: Callable without arguments for opening a new channel.
+    :type open_channel: callable
+    :param size: Number of channels to keep open.
+    :type size: int
+    :param retry_delay: Time in seconds to wait before retrying, if opening a channel fails.
+    :type retry_delay: float
+    """
+    def __init__(self, open_channel, size, retry_delay=1):
+        self.open_channel = open_channel
+        self.size = size
+        self.retry_delay = retry_delay
+        self.hits = 0
+        self.misses = 0
+        self._channels = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._closed = False
+        self._thread = ThreadHandler('channel_pool', self._run)
+        self._refill.set()
+
+    def _run(self):
+        while not self._closed:
+            self._refill.wait(1)
+            self._refill.clear()
+            while not self._closed and len(self._channels) < self.size:
+                try:
+                    channel = self.open_channel()
+                except Exception as e:
+                    log.warning("Failed to open channel for pool: %s", e)
+                    time.sleep(self.retry_delay)
+                    continue
+                with self._lock:
+                    if self._closed:
+                        _close_quietly(channel)
+                        return
+                    self._channels.append(channel)
+
+    def get(self):
+        """
+        Takes a channel from the pool, and starts to replace it.
+
+        :return: An open channel, or ``None`` if no channel was available.
+        :rtype: paramiko.channel.Channel
+        """
+        with self._lock:
+            while self._channels:
+                channel = self._channels.popleft()
+                if not (channel.closed or channel.eof_received):
+                    self.hits += 1
+                    self._refill.set()
+                    return channel
+                _close_quietly(channel)
+            self.misses += 1
+        self._refill.set()
+        return None
+
+    @property
+    def available(self):
+        """
+        Number of channels currently ready for use.
+
+        :rtype: int
+        """
+        return len(self._channels)
+
+    @property
+    def hit_rate(self):
+        """
+        Share of requests that could be served by a pre-opened channel.
+
+        :rtype: float
+        """
+        requests = self.hits + self.misses
+        if requests:
+            return self.hits / float(requests)
+        return 0.0
+
+    def close(self):
+        """
+        Stops refilling the pool and closes all channels that have not been used.
+        """
+        with self._lock:
+            self._closed = True
+            channels, self._channels = self._channels, deque()
+        self._refill.set()
+        for channel in channels:
+            _close_quietly(channel)
+        self._thread.thread.join()
+
+    def __str__(self):
+        return "{0} of {1} channels ready, hit rate {2:.1%}".format(self.available, self.size, self.hit_rate)
+
+
+class ChannelScheduler(object):
+    """
+    Admission control for channels on the SSH connections to a host. Opening a channel waits until a transport has
+    fewer than ``max_channels`` open channels, so that the server's ``MaxSessions`` limit is not exceeded. If the server
+    rejects a channel nevertheless, opening is retried with an increasing delay.
+
+    If all transports are busy, up to ``max_transports`` connections to the host are used, where the first one is the
+    connection of Fabric. Additional connections use the same parameters. With ``bulk_transport``, bulk transfers are
+    moved to a separate connection, so that they do not slow down short requests.
+
+    :param host_string: Fabric host string.
+    :type host_string: unicode
+    :param max_channels: Maximum number of simultaneously open channels per transport. ``0`` means no limit.
+    :type max_channels: int
+    :param max_transports: Maximum number of SSH transports for regular channels.
+    :type max_transports: int
+    :param bulk_transport: Whether to open a dedicated transport for bulk transfers.
+    :type bulk_transport: bool
+    :param retries: Number of retries if the server rejects a channel.
+    :type retries: int
+    :param retry_delay: Time in seconds before the first retry; doubled for every further attempt.
+    :type retry_delay: float
+    :param timeout: Maximum time in seconds to wait for a transport to accept another channel.
+    :type timeout: float
+    """
+    def __init__(self, host_string, max_channels=0, max_transports=1, bulk_transport=False, retries=3,
+                 retry_delay=0.5, timeout=60):
+        self.host_string = host_string
+        self.max_channels = max_channels
+        self.max_transports = max(max_transports, 1)
+        self.bulk_transport = bulk_transport
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._clients = []
+        self._bulk_client = None
+        self._channels = {}
+        self._pending = {}
+        # Connections being opened, which count towards max_transports.
+        self._connecting = 0
+        self._bulk_connecting = False
+
+    def _connect(self):
+        user, host, port = normalize(self.host_string)
+        log.debug("Opening additional SSH connection to %s.", self.host_string)
+        return connect(user, host, port, connections)
+
+    def _add_client(self, bulk):
+        # Connects without holding the lock, so that channels can be opened on other transports in the meantime.
+        client = None
+        try:
+            client = self._connect()
+        finally:
+            with self._lock:
+                if bulk:
+                    self._bulk_connecting = False
+                    if client is not None:
+                        self._bulk_client = client
+                else:
+                    self._connecting -= 1
+                    if client is not None:
+                        self._clients.append(client)
+
+    def _get_transports(self, bulk):
+        if bulk and self.bulk_transport:
+            transport = self._bulk_client and self._bulk_client.get_transport()
+            if transport is None or not transport.is_active():
+                return []
+            return [transport]
+        self._clients = [client for client in self._clients
+                         if client.get_transport() is not None and client.get_transport().is_active()]
+        transports = [connections[self.host_string].get_transport()]
+        transports.extend(client.get_transport() for client in self._clients)
+        return transports
+
+    def _load(self, transport):
+        channels = [channel for channel in self._channels.get(transport, ()) if not channel.closed]
+        self._channels[transport] = channels
+        return len(channels) + self._pending.get(transport, 0)
+
+    def _acquire(self, bulk):
+        end_ts = time.time() + self.timeout
+        while True:
+            connect = False
+            with self._lock:
+                transports = self._get_transports(bulk)
+                for transport in list(self._channels):
+                    if not (transport.is_active() or self._pending.get(transport)):
+                        del self._channels[transport]
+                transport = None
+                if transports:
+                    load, index = min((self._load(transport), index) for index, transport in enumerate(transports))
+                    if not (load and self.max_channels and load >= self.max_channels):
+                        transport = transports[index]
+                if transport is not None:
+                    self._pending[transport] = self._pending.get(transport, 0) + 1
+                    return transport
+                if bulk and self.bulk_transport:
+                    if not (transports or self._bulk_connecting):
+                        self._bulk_connecting = connect = True
+                elif not bulk and len(transports) + self._connecting < self.max_transports:
+                    self._connecting += 1
+                    connect = True
+            if connect:
+                self._add_client(bulk)
+                continue
+            if time.time() > end_ts:
+                raise SSHException("Timed out waiting for a free channel to {0}.".format(self.host_string))
+            time.sleep(0.05)
+
+    def _release(self, transport, channel):
+        with self._lock:
+            self._pending[transport] -= 1
+            if channel is not None:
+                self._channels.setdefault(transport, []).append(channel)
+
+    def open_channel(self, open_func, bulk=False):
+        """
+        Opens a channel on the least busy transport, as soon as one is available.
+
+        :param open_func: Callable that opens the channel, with the transport as argument.
+        :type open_func: callable
+        :param bulk: Whether the channel is used for a bulk transfer.
+        :type bulk: bool
+        :return: The channel returned by ``open_func``.
+        :rtype: paramiko.channel.Channel
+        """
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            transport = self._acquire(bulk)
+            channel = None
+            try:
+                channel = open_func(transport)
+                return channel
+            except ChannelException as e:
+                if e.code not in RETRY_CODES or attempt >= self.retries:
+                    raise
+                log.debug("SSH server %s rejected channel (%s); retrying in %s seconds.", self.host_string, e, delay)
+            finally:
+                self._release(transport, channel)
+            time.sleep(delay)
+            delay *= 2
+            attempt += 1
+
+    def open_session(self, bulk=False):
+        """
+        Opens a session channel, e.g. for running a command.
+
+        :param bulk: Whether the channel is used for a bulk transfer.
+        :type bulk: bool
+        :return: Session channel.
+        :rtype: paramiko.channel.Channel
+        """
+        return self.open_channel(lambda transport: transport.open_session(), bulk)
+
+    @property
+    def open_channels(self):
+        """
+        Number of channels currently open through this scheduler.
+
+        :rtype: int
+        """
+        with self._lock:
+            return sum(self._load(transport) for transport in list(self._channels))
+
+    def close(self):
+        """
+        Closes the additional SSH connections. The connection of Fabric remains open.
+        """
+        with self._lock:
+            clients, self._clients = self._clients, []
+            if self._bulk_client is not None:
+                clients.append(self._bulk_client)
+                self._bulk_client = None
+            self._channels = {}
+        for client in clients:
+            client.close()
+
+    def __str__(self):
+        return "{0} open channels on {1} additional transports".format(
+            self.open_channels, len(self._clients) + (1 if self._bulk_client else 0))
+
+
+class ChannelSchedulers(ConnectionDict):
+    """
+    Cache for channel schedulers per host. Their limits are set through the following ``env`` variables:
+
+    * ``env.docker_tunnel_max_channels``: Maximum number of open channels per SSH transport.
+    * ``env.docker_tunnel_transports``: Maximum number of SSH transports per host.
+    * ``env.docker_tunnel_bulk_transport``: Use a separate SSH transport for bulk transfers.
+    * ``env.docker_tunnel_channel_retries``: Number of retries for rejected channels.
+    * ``env.docker_tunnel_channel_timeout``: Time to wait for a free channel.
+    """
+    def __getitem__(self, item):
+        """
+        :param item: Fabric host string.
+        :type item: unicode
+        :return: Channel scheduler.
+        :rtype: ChannelScheduler
+        """
+        def _create_scheduler():
+            return ChannelScheduler(item,
+                                    int(env.get('docker_tunnel_max_channels') or 0),
+                                    int(env.get('docker_tunnel_transports') or 1),
+                                    env.get('docker_tunnel_bulk_transport', False),
+                                    int(env.get('docker_tunnel_channel_retries', 3)),
+                                    timeout=float(env.get('docker_tunnel_channel_timeout') or 60))
+
+        return self.get_or_create_connection(item, _create_scheduler)
+
+
+channel_schedulers = ChannelSchedulers()
 
 
 class LocalTunnel(object):
@@ -82,21 +875,81 @@ class LocalTunnel(object):
     :type remote_port: int
     :param remote_host: Host to connect to. Optional, default is ``localhost``.
     :type remote_host: unicode
-    :param bind_port: Local port to bind to. Optional, default is same as ``remote_port``.
+    :param bind_port: Local port to bind to. Optional, default is same as ``remote_port``. If set to ``0``, or if the
+      port is in use, an ephemeral port is assigned by the operating system. The actual port is available in
+      :attr:`bind_port` after :meth:`connect`.
     :type bind_port: int
     :param bind_host: Local address to bind to. Optional, default is ``localhost``.
+    :param engine: Forwarding engine; ``thread`` (default) starts a thread for every connection, whereas ``selector``
+      moves data of all connections in a single :class:`ForwardingLoop`. If not set, will use
+      ``env.docker_tunnel_engine``.
+    :type engine: unicode
+    :param buffer_size: Maximum size of data to read and write at once. If not set, will use
+      ``env.docker_tunnel_buffer_size`` or default to 64 KiB.
+    :type buffer_size: int
+    :param backlog: Maximum number of pending connections on the local port. If not set, will use
+      ``env.docker_tunnel_listen_backlog`` or default to the system maximum.
+    :type backlog: int
+    :param local_socket: Listen on a Unix socket in a private temporary directory instead of a local TCP port. The
+      path is available in :attr:`bind_socket` after :meth:`connect`. If not set, will use
+      ``env.docker_tunnel_local_socket``.
+    :type local_socket: bool
+    :param pool_size: Number of channels to open ahead of demand in a :class:`ChannelPool`. If not set, will use
+      ``env.docker_tunnel_channel_pool_size``; ``0`` (default) disables the pool.
+    :type pool_size: int
     """
-    def __init__(self, remote_port, remote_host=None, bind_port=None, bind_host=None, remote_cmd=None):
+    def __init__(self, remote_port, remote_host=None, bind_port=None, bind_host=None, remote_cmd=None, engine=None,
+                 buffer_size=None, backlog=None, local_socket=None, pool_size=None):
         self.remote_port = remote_port
         self.remote_host = remote_host or 'localhost'
-        self.bind_port = bind_port or remote_port
+        self.bind_port = bind_port if bind_port is not None else remote_port
         self.bind_host = bind_host or 'localhost'
         self.remote_cmd = remote_cmd
-        self.sockets = []
-        self.channels = []
-        self.threads = []
+        self.engine = engine or env.get('docker_tunnel_engine') or ENGINE_THREAD
+        if self.engine not in (ENGINE_THREAD, ENGINE_SELECTOR):
+            raise ValueError("Invalid forwarding engine.", self.engine)
+        self.buffer_size = int(buffer_size or env.get('docker_tunnel_buffer_size') or DEFAULT_BUFFER_SIZE)
+        self.backlog = int(backlog or env.get('docker_tunnel_listen_backlog') or socket.SOMAXCONN)
+        if local_socket is None:
+            local_socket = env.get('docker_tunnel_local_socket', False)
+        if local_socket and not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("Unix sockets are not supported on this platform.")
+        self.local_socket = local_socket
+        self.bind_socket = None
+        self.pool_size = int(pool_size or env.get('docker_tunnel_channel_pool_size') or 0)
+        self.channel_pool = None
+        self.statistics = TunnelStatistics()
+        self.forwarders = set()
+        self._forwarders_lock = threading.Lock()
         self.listening_socket = None
         self.listening_thread = None
+        self.transport = None
+        self.scheduler = None
+
+    @property
+    def sockets(self):
+        """
+        Local sockets of the currently active connections.
+
+        :rtype: list[socket.socket]
+        """
+        with self._forwarders_lock:
+            return [forwarder.socket for forwarder in self.forwarders]
+
+    @property
+    def channels(self):
+        """
+        SSH channels of the currently active connections.
+
+        :rtype: list[paramiko.channel.Channel]
+        """
+        with self._forwarders_lock:
+            return [forwarder.channel for forwarder in self.forwarders]
+
+    def _forwarder_finished(self, forwarder):
+        with self._forwarders_lock:
+            self.forwarders.discard(forwarder)
+        self.statistics.connection_closed()
 
     def get_channel(self, transport, remote_addr, local_peer):
         channel = transport.open_channel('direct-tcpip', remote_addr, local_peer)
@@ -104,6 +957,19 @@ class LocalTunnel(object):
             raise Exception('Incoming request to %s:%d was rejected by the SSH server.' % remote_addr)
         return channel
 
+    def open_channel(self, remote_addr, local_peer):
+        """
+        Opens a channel for a new connection through the :class:`ChannelScheduler` of the host.
+
+        :param remote_addr: Remote host and port.
+        :type remote_addr: tuple
+        :param local_peer: Address of the local peer.
+        :type local_peer: tuple
+        :return: New channel.
+        :rtype: paramiko.channel.Channel
+        """
+        return self.scheduler.open_channel(lambda transport: self.get_channel(transport, remote_addr, local_peer))
+
     @needs_host
     def connect(self):
         def listener_thread_main(thead_sock, callback, *a, **kw):
@@ -121,38 +987,94 @@ class LocalTunnel(object):
                 if e[0] != socket.EBADF:
                     raise
 
-        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listening_socket.bind((self.bind_host, self.bind_port))
-        listening_socket.listen(1)
+        def bind(port):
+            new_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            new_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                new_socket.bind((self.bind_host, port))
+            except socket.error:
+                new_socket.close()
+                raise
+            return new_socket
 
-        def accept(listen_sock, transport, remote_addr):
-            accept_sock, local_peer = listen_sock.accept()
-            channel = self.get_channel(transport, remote_addr, local_peer)
+        def bind_unix():
+            socket_dir = tempfile.mkdtemp(prefix='dockerfabric-')
+            socket_path = os.path.join(socket_dir, 'docker.sock')
+            new_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                new_socket.bind(socket_path)
+            except socket.error:
+                new_socket.close()
+                shutil.rmtree(socket_dir, ignore_errors=True)
+                raise
+            return new_socket, socket_path
+
+        if self.local_socket:
+            listening_socket, self.bind_socket = bind_unix()
+        else:
+            try:
+                listening_socket = bind(self.bind_port)
+            except socket.error as e:
+                if not self.bind_port or e.errno != errno.EADDRINUSE:
+                    raise
+                log.warning("Local port %s is in use; binding tunnel to an ephemeral port instead.", self.bind_port)
+                listening_socket = bind(0)
+            self.bind_port = listening_socket.getsockname()[1]
+        listening_socket.listen(self.backlog)
 
-            handler = ThreadHandler('fwd', _forwarder, channel, accept_sock)
+        def accept(listen_sock, remote_addr):
+            accept_sock, local_peer = listen_sock.accept()
+            if not isinstance(local_peer, tuple):
+                # Peers on Unix sockets have no address, but TCP channels require one.
+                local_peer = ('127.0.0.1', 0)
+            channel = self.channel_pool and self.channel_pool.get()
+            if channel is None:
+                channel = self.open_channel(remote_addr, local_peer)
 
-            self.sockets.append(accept_sock)
-            self.channels.append(channel)
-            self.threads.append(handler)
+            self.statistics.connection_opened()
+            # Finished forwarders remove themselves. If that happens before this block is left, they are not added.
+            with self._forwarders_lock:
+                if self.engine == ENGINE_SELECTOR:
+                    forwarder = get_forwarding_loop().add(channel, accept_sock, self.buffer_size, self.statistics,
+                                                          self._forwarder_finished)
+                else:
+                    forwarder = ThreadForwarder(channel, accept_sock, self.buffer_size, self.statistics,
+                                                self._forwarder_finished)
+                if forwarder.is_alive():
+                    self.forwarders.add(forwarder)
 
-        self.sockets = []
-        self.channels = []
-        self.threads = []
+        self.forwarders = set()
+        self.transport = connections[env.host_string].get_transport()
+        self.scheduler = channel_schedulers[env.host_string]
         self.listening_socket = listening_socket
+        remote_address = self.remote_host, self.remote_port
+        if self.pool_size:
+            # Pre-opened channels do not have a local peer yet.
+            self.channel_pool = ChannelPool(lambda: self.open_channel(remote_address, ('127.0.0.1', 0)), self.pool_size)
         self.listening_thread = ThreadHandler('local_bind', listener_thread_main,
-                                              listening_socket, accept,
-                                              connections[env.host_string].get_transport(),
-                                              (self.remote_host, self.remote_port))
+                                              listening_socket, accept, remote_address)
+
+    def is_alive(self):
+        """
+        Checks if the tunnel is still accepting connections and its SSH connection is active.
+
+        :return: ``True`` if the tunnel is usable, ``False`` otherwise.
+        :rtype: bool
+        """
+        return (self.listening_thread is not None and self.listening_thread.thread.is_alive() and
+                self.transport is not None and self.transport.is_active())
 
     def close(self):
-        for sock, chan, th in zip(self.sockets, self.channels, self.threads):
-            sock.close()
-            if not chan.closed:
-                chan.close()
-            th.thread.join()
-            th.raise_if_needed()
+        if self.channel_pool is not None:
+            self.channel_pool.close()
+        with self._forwarders_lock:
+            forwarders = list(self.forwarders)
+        for forwarder in forwarders:
+            forwarder.close()
 
         self.listening_socket.close()
+        if self.bind_socket:
+            shutil.rmtree(os.path.dirname(self.bind_socket), ignore_errors=True)
         self.listening_thread.thread.join()
         self.listening_thread.raise_if_needed()
+        log.debug("Closed tunnel to %s:%s; %s.", self.remote_host, self.remote_port, self.statistics)
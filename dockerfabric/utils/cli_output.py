@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from calendar import timegm
+from collections import OrderedDict
+import json
+import re
+
+NONE_TAG = '<none>'
+NONE_IMAGE_TAG = '<none>:<none>'
+
+CREATED_AT_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})(?:\.\d+)? ([+-])(\d{2})(\d{2})')
+PORT_PATTERN = re.compile(r'(?:(?P<IP>[0-9a-fA-F.:]*):(?P<PublicPort>\d+(?:-\d+)?)->)?'
+                          r'(?P<PrivatePort>\d+(?:-\d+)?)/(?P<Type>\w+)')
+SIZE_PATTERN = re.compile(r'([\d.]+)\s*([kKMGTP]?)B')
+SIZE_UNITS = {'': 1, 'k': 1000, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4, 'P': 1000 ** 5}
+
+
+def _parse_created(value):
+    match = CREATED_AT_PATTERN.match(value)
+    if not match:
+        return 0
+    groups = match.groups()
+    timestamp = timegm(tuple(map(int, groups[:6])))
+    offset = int(groups[7]) * 3600 + int(groups[8]) * 60
+    if groups[6] == '+':
+        return timestamp - offset
+    return timestamp + offset
+
+
+def _parse_size(value):
+    match = SIZE_PATTERN.match(value)
+    if not match:
+        return 0
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def _parse_labels(value):
+    if not value:
+        return {}
+    return dict(label.partition('=')[::2] for label in value.split(','))
+
+
+def _parse_bool(value):
+    return value == 'true'
+
+
+def _port_range(value):
+    start, __, end = value.partition('-')
+    return range(int(start), int(end or start) + 1)
+
+
+def _parse_ports(value):
+    ports = []
+    for match in PORT_PATTERN.finditer(value):
+        private_ports = _port_range(match.group('PrivatePort'))
+        public_port = match.group('PublicPort')
+        if public_port:
+            for private_port, public_port in zip(private_ports, _port_range(public_port)):
+                ports.append({'IP': match.group('IP') or '0.0.0.0', 'PrivatePort': private_port,
+                              'PublicPort': public_port, 'Type': match.group('Type')})
+        else:
+            ports.extend({'PrivatePort': private_port, 'Type': match.group('Type')}
+                         for private_port in private_ports)
+    return ports
+
+
+def _parse_names(value):
+    return ['/{0}'.format(name) for name in value.split(',')] if value else []
+
+
+# Fields of the Docker API result, the CLI template fields they are generated from, and the conversion.
+CONTAINER_FIELDS = OrderedDict([
+    ('Id', (('ID',), lambda d: d['ID'])),
+    ('Image', (('Image',), lambda d: d['Image'])),
+    ('Command', (('Command',), lambda d: d['Command'].strip('"'))),
+    ('Created', (('CreatedAt',), lambda d: _parse_created(d['CreatedAt']))),
+    ('State', (('State',), lambda d: d['State'])),
+    ('Status', (('Status',), lambda d: d['Status'])),
+    ('Names', (('Names',), lambda d: _parse_names(d['Names']))),
+    ('Ports', (('Ports',), lambda d: _parse_ports(d['Ports']))),
+    ('Labels', (('Labels',), lambda d: _parse_labels(d['Labels']))),
+])
+IMAGE_FIELDS = OrderedDict([
+    ('Id', (('ID',), lambda d: d['ID'])),
+    ('RepoTags', (('Repository', 'Tag'), lambda d: ['{0}:{1}'.format(d['Repository'], d['Tag'])]
+                  if d['Repository'] != NONE_TAG and d['Tag'] != NONE_TAG else [])),
+    ('RepoDigests', (('Repository', 'Digest'), lambda d: ['{0}@{1}'.format(d['Repository'], d['Digest'])]
+                     if d['Repository'] != NONE_TAG and d['Digest'] != NONE_TAG else [])),
+    ('Created', (('CreatedAt',), lambda d: _parse_created(d['CreatedAt']))),
+    ('Size', (('Size',), lambda d: _parse_size(d['Size']))),
+    ('VirtualSize', (('Size',), lambda d: _parse_size(d['Size']))),
+])
+NETWORK_FIELDS = OrderedDict([
+    ('Id', (('ID',), lambda d: d['ID'])),
+    ('Name', (('Name',), lambda d: d['Name'])),
+    ('Driver', (('Driver',), lambda d: d['Driver'])),
+    ('Scope', (('Scope',), lambda d: d['Scope'])),
+    ('Created', (('CreatedAt',), lambda d: _parse_created(d['CreatedAt']))),
+    ('EnableIPv6', (('IPv6',), lambda d: _parse_bool(d['IPv6']))),
+    ('Internal', (('Internal',), lambda d: _parse_bool(d['Internal']))),
+    ('Labels', (('Labels',), lambda d: _parse_labels(d['Labels']))),
+])
+VOLUME_FIELDS = OrderedDict([
+    ('Name', (('Name',), lambda d: d['Name'])),
+    ('Driver', (('Driver',), lambda d: d['Driver'])),
+    ('Mountpoint', (('Mountpoint',), lambda d: d['Mountpoint'])),
+    ('Scope', (('Scope',), lambda d: d['Scope'])),
+    ('Labels', (('Labels',), lambda d: _parse_labels(d['Labels']))),
+])
+
+ITEM_FIELDS = {
+    'container': CONTAINER_FIELDS,
+    'image': IMAGE_FIELDS,
+    'network': NETWORK_FIELDS,
+    'volume': VOLUME_FIELDS,
+}
+
+
+def _get_field_specs(item_type, fields):
+    item_fields = ITEM_FIELDS[item_type]
+    if not fields:
+        return item_fields
+    # Images are combined by their id.
+    if item_type == 'image' and 'Id' not in fields:
+        fields = ['Id'] + list(fields)
+    try:
+        return OrderedDict((field, item_fields[field]) for field in fields)
+    except KeyError as e:
+        raise ValueError("Field is not available from the command line.", item_type, e.args[0])
+
+
+def get_json_format_arg(item_type, fields=None):
+    """
+    Returns the argument for listing containers, images, networks, or volumes on the Docker command line as JSON, with
+    one object per line. If fields are given, the output is limited to what is needed for generating them.
+
+    :param item_type: Type of the listed items, i.e. ``container``, ``image``, ``network``, or ``volume``.
+    :type item_type: unicode
+    :param fields: Optional; fields of the Docker API result to include, e.g. ``['Id', 'Names']``.
+    :type fields: list[unicode]
+    :return: Command line argument.
+    :rtype: unicode
+    """
+    if not fields:
+        return "--format='{{json .}}'"
+    cli_fields = []
+    for field_cli_names, __ in _get_field_specs(item_type, fields).values():
+        cli_fields.extend(name for name in field_cli_names if name not in cli_fields)
+    return "--format='{{{0}}}'".format(','.join('"{0}":{{{{json .{0}}}}}'.format(name) for name in cli_fields))
+
+
+def iter_json_lines(out):
+    """
+    Parses output with one JSON object per line.
+
+    :param out: CLI output.
+    :type out: unicode | str
+    :return: Generator of parsed objects.
+    """
+    for line in (out or '').splitlines():
+        if line.strip():
+            yield json.loads(line)
+
+
+def _convert(line_dict, field_specs):
+    return {
+        field: convert(line_dict)
+        for field, (field_cli_names, convert) in field_specs.items()
+        if all(name in line_dict for name in field_cli_names)
+    }
+
+
+def _combine_images(images):
+    combined = OrderedDict()
+    for image in images:
+        existing = combined.get(image['Id'])
+        if existing is None:
+            combined[image['Id']] = image
+        else:
+            for key in ('RepoTags', 'RepoDigests'):
+                if key in image:
+                    existing[key].extend(t for t in image[key] if t not in existing[key])
+    for image in combined.values():
+        if 'RepoTags' in image and not image['RepoTags']:
+            image['RepoTags'] = [NONE_IMAGE_TAG]
+    return list(combined.values())
+
+
+def parse_json_output(out, item_type, fields=None):
+    """
+    Parses the output of listing containers, images, networks, or volumes on the Docker command line, using the
+    argument from :func:`get_json_format_arg`. Returns it in the format of the Docker API, as far as the information is
+    available. Images are listed once per tag on the command line, and are combined by their id.
+
+    :param out: CLI output.
+    :type out: unicode | str
+    :param item_type: Type of the listed items, i.e. ``container``, ``image``, ``network``, or ``volume``.
+    :type item_type: unicode
+    :param fields: Optional; fields of the Docker API result to include. Has to match the fields passed to
+      :func:`get_json_format_arg`.
+    :type fields: list[unicode]
+    :return: Parsed result.
+    :rtype: list[dict]
+    """
+    field_specs = _get_field_specs(item_type, fields)
+    items = [_convert(line_dict, field_specs) for line_dict in iter_json_lines(out)]
+    if item_type == 'image':
+        return _combine_images(items)
+    return items
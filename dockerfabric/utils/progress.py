@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import os
+import sys
+import time
+
+from fabric.api import env
+from fabric.utils import fastprint, puts
+import six
+
+from dockermap.client.base import LOG_PROGRESS_FORMAT
+
+RENDERER_COALESCED = 'coalesced'
+RENDERER_LINES = 'lines'
+RENDERER_NONE = 'none'
+DEFAULT_REDRAW_INTERVAL = 0.2
+DEFAULT_SUMMARY_INTERVAL = 10
+
+progress_fmt = LOG_PROGRESS_FORMAT.format
+
+
+class ProgressRenderer(object):
+    """
+    Shows progress information of a single operation, such as an image pull or push. This implementation does not
+    output anything, but passes each update to the callback, if set.
+
+    :param callback: Optional callable, which receives status, object id, and progress bar of every update.
+    :type callback: callable
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+
+    def update(self, status, object_id, progress):
+        """
+        Processes a progress update.
+
+        :param status: Status text.
+        :type status: unicode
+        :param object_id: Object that the progress is reported on, e.g. an image layer.
+        :type object_id: unicode
+        :param progress: Progress bar.
+        :type progress: unicode
+        """
+        if self.callback is not None:
+            self.callback(status, object_id, progress)
+        self.render(status, object_id, progress)
+
+    def render(self, status, object_id, progress):
+        pass
+
+    def interrupt(self):
+        """
+        Called before other output is written in between updates.
+        """
+        pass
+
+    def finish(self):
+        """
+        Called when the operation has ended.
+        """
+        pass
+
+
+class LineProgressRenderer(ProgressRenderer):
+    """
+    Prints every update on a new line.
+    """
+    def render(self, status, object_id, progress):
+        fastprint(progress_fmt(status, object_id, progress), end='\n')
+
+
+class CoalescedProgressRenderer(ProgressRenderer):
+    """
+    Keeps the latest status of each object, and only shows it at a limited rate. On a terminal, one line per object is
+    redrawn in place at most every ``redraw_interval`` seconds. Otherwise, a summary of the number of objects per status
+    is printed every ``summary_interval`` seconds.
+
+    :param callback: Optional callable, which receives status, object id, and progress bar of every update.
+    :type callback: callable
+    :param redraw_interval: Minimum time in seconds between redraws on a terminal. If not set, will use
+      ``env.docker_progress_interval`` or 0.2 seconds.
+    :type redraw_interval: float
+    :param summary_interval: Time in seconds between summaries if not on a terminal. If not set, will use
+      ``env.docker_progress_summary_interval`` or 10 seconds.
+    :type summary_interval: float
+    :param tty: Whether output is written to a terminal. By default checks `stdout`.
+    :type tty: bool
+    """
+    def __init__(self, callback=None, redraw_interval=None, summary_interval=None, tty=None):
+        super(CoalescedProgressRenderer, self).__init__(callback)
+        self.tty = sys.stdout.isatty() if tty is None else tty
+        if self.tty:
+            self.interval = float(redraw_interval or env.get('docker_progress_interval') or DEFAULT_REDRAW_INTERVAL)
+        else:
+            self.interval = float(summary_interval or env.get('docker_progress_summary_interval') or
+                                  DEFAULT_SUMMARY_INTERVAL)
+        self.width = int(os.environ.get('COLUMNS') or 80) - 1
+        self.objects = OrderedDict()
+        self._drawn_lines = 0
+        self._last_output = time.time()
+        self._changed = False
+
+    def render(self, status, object_id, progress):
+        self.objects[object_id] = status, progress
+        self._changed = True
+        if time.time() - self._last_output >= self.interval:
+            self._output()
+
+    def _output(self):
+        if self.tty:
+            self._redraw()
+        else:
+            puts(self.get_summary())
+        self._last_output = time.time()
+        self._changed = False
+
+    def _redraw(self):
+        lines = []
+        if self._drawn_lines:
+            lines.append('\x1b[{0}A'.format(self._drawn_lines))
+        for object_id, (status, progress) in six.iteritems(self.objects):
+            lines.append('\x1b[2K{0}\n'.format(progress_fmt(status, object_id, progress)[:self.width]))
+        fastprint(''.join(lines))
+        self._drawn_lines = len(self.objects)
+
+    def get_summary(self):
+        """
+        Returns the number of objects per status.
+
+        :rtype: unicode
+        """
+        counts = OrderedDict()
+        for status, progress in six.itervalues(self.objects):
+            counts[status] = counts.get(status, 0) + 1
+        return "{0} objects: {1}".format(len(self.objects), ', '.join('{0} {1}'.format(count, status)
+                                                                       for status, count in six.iteritems(counts)))
+
+    def interrupt(self):
+        # Output in between is written below the current block, and the next redraw starts after it.
+        self._drawn_lines = 0
+
+    def finish(self):
+        if self._changed:
+            self._output()
+
+
+RENDERERS = {
+    RENDERER_COALESCED: CoalescedProgressRenderer,
+    RENDERER_LINES: LineProgressRenderer,
+    RENDERER_NONE: ProgressRenderer,
+}
+
+
+def get_progress_renderer():
+    """
+    Creates a progress renderer as configured in ``env.docker_progress_renderer``. This can be the name ``coalesced``
+    (default), ``lines``, or ``none``, or a callable that returns a :class:`ProgressRenderer` instance. The callback set
+    in ``env.docker_progress_callback`` is passed to the renderer.
+
+    :return: Progress renderer.
+    :rtype: ProgressRenderer
+    """
+    renderer = env.get('docker_progress_renderer') or RENDERER_COALESCED
+    callback = env.get('docker_progress_callback')
+    if isinstance(renderer, six.string_types):
+        try:
+            renderer = RENDERERS[renderer]
+        except KeyError:
+            raise ValueError("Invalid progress renderer.", renderer)
+    return renderer(callback)
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import tarfile
+import threading
+import time
+import zlib
+
+from fabric.api import env
+from fabric.utils import fastprint, puts
+import six
+from six.moves import queue
+
+from dockermap.shortcuts import get_user_group
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_PROGRESS_INTERVAL = 2
+
+_MAGIC_NUMBERS = (
+    (b'\x1f\x8b', COMPRESSION_GZIP),
+    (b'\x28\xb5\x2f\xfd', COMPRESSION_ZSTD),
+)
+
+
+def format_size(size):
+    """
+    Formats a number of bytes for output, e.g. ``12.3 MiB``.
+
+    :param size: Number of bytes.
+    :type size: int | float
+    :rtype: unicode
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f} TiB'.format(size)
+
+
+def detect_compression(filename):
+    """
+    Detects the compression of a file from its first bytes.
+
+    :param filename: Path to the local file.
+    :type filename: unicode
+    :return: ``gzip``, ``zstd``, or ``None`` if the file is not compressed in one of these formats.
+    :rtype: unicode
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(4)
+    for magic, compression in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+class TransferProgress(object):
+    """
+    Prints the amount of data transferred and the throughput at a fixed interval. On a terminal, the line is updated in
+    place.
+
+    :param label: Text to show in front of the progress.
+    :type label: unicode
+    :param total: Total number of bytes, if known.
+    :type total: int
+    :param interval: Time in seconds between updates. By default uses ``env.docker_transfer_progress_interval`` or 2
+      seconds.
+    :type interval: float
+    """
+    def __init__(self, label, total=None, interval=None):
+        self.label = label
+        self.total = total
+        self.interval = float(interval or env.get('docker_transfer_progress_interval') or DEFAULT_PROGRESS_INTERVAL)
+        self.transferred = 0
+        self.start_time = time.time()
+        self._last_output = self.start_time
+        self._tty = sys.stdout.isatty()
+
+    @property
+    def rate(self):
+        """
+        Average number of bytes per second.
+
+        :rtype: float
+        """
+        duration = time.time() - self.start_time
+        return self.transferred / duration if duration > 0 else 0.0
+
+    def get_line(self):
+        """
+        Returns the current progress.
+
+        :rtype: unicode
+        """
+        if self.total:
+            amount = '{0} of {1}'.format(format_size(self.transferred), format_size(self.total))
+        else:
+            amount = format_size(self.transferred)
+        return '{0}: {1} ({2}/s)'.format(self.label, amount, format_size(self.rate))
+
+    def _print(self):
+        if self._tty:
+            fastprint('\r{0}\x1b[K'.format(self.get_line()))
+        else:
+            puts(self.get_line())
+        self._last_output = time.time()
+
+    def update(self, size):
+        """
+        Adds to the number of transferred bytes and prints the progress, if the interval has passed.
+
+        :param size: Number of bytes.
+        :type size: int
+        """
+        self.transferred += size
+        if time.time() - self._last_output >= self.interval:
+            self._print()
+
+    def finish(self):
+        """
+        Prints the final amount and throughput.
+        """
+        self._print()
+        if self._tty:
+            fastprint('\n')
+
+
+def read_chunks(fileobj, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Reads a file in chunks of a fixed size.
+
+    :param fileobj: File opened in binary mode.
+    :param chunk_size: Size of each chunk.
+    :type chunk_size: int
+    :param progress: Optional; progress to update with the size of every chunk.
+    :type progress: TransferProgress
+    :return: Generator of byte strings.
+    """
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        if progress is not None:
+            progress.update(len(chunk))
+        yield chunk
+
+
+def _unzstd_chunks(chunks):
+    if zstandard is None:
+        raise ValueError("Decompressing zstd requires the zstandard package.")
+    dctx = zstandard.ZstdDecompressor()
+    decompressor = dctx.decompressobj()
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            # Files written by parallel compressors or appended to each other can consist of multiple frames.
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = dctx.decompressobj()
+
+
+def decompress_chunks(chunks, compression):
+    """
+    Decompresses a stream of data on the fly.
+
+    :param chunks: Iterable of compressed byte strings.
+    :param compression: ``zstd``, or ``None`` for passing the data through unchanged.
+    :type compression: unicode
+    :return: Generator of decompressed byte strings.
+    """
+    if compression == COMPRESSION_ZSTD:
+        return _unzstd_chunks(chunks)
+    elif compression is None:
+        return iter(chunks)
+    raise ValueError("Invalid compression.", compression)
+
+
+def _gzip_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    Compresses data in blocks using multiple threads, and writes them as consecutive gzip members, which is a valid
+    gzip file. Compression runs while more data is written, and the number of pending blocks is limited, so that memory
+    use remains bounded.
+
+    :param fileobj: File opened in binary mode to write the compressed data to.
+    :param level: Compression level.
+    :type level: int
+    :param threads: Number of compression threads. By default uses the number of CPUs.
+    :type threads: int
+    :param block_size: Size of the uncompressed data per block.
+    :type block_size: int
+    """
+    def __init__(self, fileobj, level=6, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or cpu_count()
+        self._pool = ThreadPool(self.threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def _write_pending(self, max_pending):
+        while len(self._pending) > max_pending:
+            self.fileobj.write(self._pending.popleft().get())
+
+    def _submit(self):
+        block = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(_gzip_block, (block, self.level)))
+        self._write_pending(self.threads * 2)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def close(self):
+        """
+        Compresses and writes the remaining data. Does not close the file.
+        """
+        try:
+            if self._buffered:
+                self._submit()
+            self._write_pending(0)
+        finally:
+            self._pool.terminate()
+
+
+def get_compressing_writer(fileobj, compression, threads=None):
+    """
+    Returns a writer that compresses data in multiple threads.
+
+    :param fileobj: File opened in binary mode to write the compressed data to.
+    :param compression: ``gzip`` or ``zstd``.
+    :type compression: unicode
+    :param threads: Number of compression threads. By default uses the number of CPUs.
+    :type threads: int
+    :return: Object with the methods ``write`` and ``close``.
+    """
+    if compression == COMPRESSION_GZIP:
+        return ParallelGzipWriter(fileobj, threads=threads)
+    elif compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError("Compressing zstd requires the zstandard package.")
+        return zstandard.ZstdCompressor(threads=threads or -1).stream_writer(fileobj, closefd=False)
+    raise ValueError("Invalid compression.", compression)
+
+
+def _get_numeric_ids(apply_chown):
+    user, __, group = get_user_group(apply_chown).partition(':')
+    try:
+        return int(user), int(group)
+    except ValueError:
+        raise ValueError("Owners inside an archive have to be set as numeric user and group ids.", apply_chown)
+
+
+class _QueueWriter(object):
+    def __init__(self, chunk_queue, stopped):
+        self.chunk_queue = chunk_queue
+        self.stopped = stopped
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunk_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise IOError("The archive is no longer read.")
+
+    write = put
+
+
+def iter_tar_stream(local_path, apply_chown=None, apply_chmod=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Generates an uncompressed tar archive of a local file or directory while it is read, without storing the archive.
+    The contents of a directory are placed at the root of the archive; a single file is stored under its base name. The
+    archive is written in a separate thread, and only a few chunks are held in memory at a time.
+
+    :param local_path: Local file or directory.
+    :type local_path: unicode
+    :param apply_chown: Owner to set for all files and directories in the archive, as numeric ids in the notation
+      ``user:group``, or as a tuple ``(user, group)``.
+    :type apply_chown: unicode | int | tuple
+    :param apply_chmod: Permissions to set for all files and directories in the archive, as octal notation. Directories
+      are also made searchable for those who can read them, e.g. ``644`` results in ``755`` for directories.
+    :type apply_chmod: unicode | int
+    :param chunk_size: Approximate size of the generated chunks.
+    :type chunk_size: int
+    :return: Generator of byte strings.
+    """
+    owner = _get_numeric_ids(apply_chown) if apply_chown is not None else None
+    if isinstance(apply_chmod, six.string_types):
+        mode = int(apply_chmod, 8)
+    else:
+        mode = apply_chmod
+
+    def _set_attributes(tarinfo):
+        if owner is not None:
+            tarinfo.uid, tarinfo.gid = owner
+            tarinfo.uname = tarinfo.gname = ''
+        if mode is not None:
+            if tarinfo.isdir():
+                tarinfo.mode = mode | ((mode & 0o444) >> 2)
+            else:
+                tarinfo.mode = mode
+        return tarinfo
+
+    def _write_archive():
+        try:
+            with tarfile.open(fileobj=writer, mode='w|', bufsize=chunk_size) as archive:
+                if os.path.isdir(local_path):
+                    for name in sorted(os.listdir(local_path)):
+                        archive.add(os.path.join(local_path, name), arcname=name, filter=_set_attributes)
+                else:
+                    archive.add(local_path, arcname=os.path.basename(local_path), filter=_set_attributes)
+        except Exception as e:
+            result = e
+        else:
+            result = None
+        try:
+            writer.put(result)
+        except IOError:
+            # The consumer has stopped.
+            pass
+
+    chunk_queue = queue.Queue(4)
+    stopped = threading.Event()
+    writer = _QueueWriter(chunk_queue, stopped)
+    thread = threading.Thread(target=_write_archive, name='tar_stream')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                break
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Lets the archive thread end if the consumer has stopped early.
+        stopped.set()
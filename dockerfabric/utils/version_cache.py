@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import threading
+import time
+
+from fabric.api import env
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = '~/.docker-fabric/api_versions.json'
+DEFAULT_CACHE_TTL = 86400
+
+
+class ApiVersionCache(object):
+    """
+    Keeps the API versions of Docker services in a local file, so that they do not have to be requested again in every
+    process. The file is set in ``env.docker_api_version_cache`` (default ``~/.docker-fabric/api_versions.json``);
+    setting it to ``False`` disables the cache. Entries expire after ``env.docker_api_version_cache_ttl`` seconds
+    (default one day).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_path():
+        path = env.get('docker_api_version_cache', DEFAULT_CACHE_FILE)
+        if not path:
+            return None
+        return os.path.expanduser(path)
+
+    @staticmethod
+    def _get_ttl():
+        return float(env.get('docker_api_version_cache_ttl') or DEFAULT_CACHE_TTL)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, path, entries):
+        min_time = time.time() - self._get_ttl()
+        current = {key: entry for key, entry in entries.items() if entry['time'] >= min_time}
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(current, f)
+        os.rename(temp_path, path)
+
+    def get(self, key):
+        """
+        Returns the cached API version.
+
+        :param key: Identifies the Docker service, e.g. by host and command line.
+        :type key: unicode
+        :return: API version, or ``None`` if it is not cached or the entry has expired.
+        :rtype: unicode
+        """
+        path = self._get_path()
+        if not path:
+            return None
+        with self._lock:
+            entry = self._read(path).get(key)
+        if entry and time.time() - entry['time'] < self._get_ttl():
+            return entry['version']
+        return None
+
+    def set(self, key, version):
+        """
+        Stores an API version. Expired entries are removed from the file at the same time.
+
+        :param key: Identifies the Docker service, e.g. by host and command line.
+        :type key: unicode
+        :param version: API version.
+        :type version: unicode
+        """
+        path = self._get_path()
+        if not path:
+            return
+        with self._lock:
+            # Re-read, since other processes may have written to the file in the meantime.
+            entries = self._read(path)
+            entries[key] = {'version': version, 'time': time.time()}
+            try:
+                self._write(path, entries)
+            except (IOError, OSError) as e:
+                log.warning("Could not write API version cache %s: %s", path, e)
+
+
+api_version_cache = ApiVersionCache()
@@ -25,6 +25,8 @@ setup(
     install_requires=['six', 'Fabric>=1.8.0', 'docker-py>=1.9.0', 'docker-map>=0.8.0b2'],
     extras_require={
         'yaml': ['PyYAML'],
+        'selector': ['selectors34; python_version < "3.4"'],
+        'zstd': ['zstandard>=0.15'],
     },
     license='MIT',
     author='Matthias Erll',
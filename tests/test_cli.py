@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import unittest
+
+from dockerfabric.cli import _match_inspected
+
+
+class MatchInspectedTest(unittest.TestCase):
+    def test_name_before_id_prefix(self):
+        web = {'Id': 'db0123456789', 'Name': '/web'}
+        db = {'Id': 'abcdef012345', 'Name': '/db'}
+        results, failed = _match_inspected([db, web], ['db', 'web'])
+        self.assertEqual(results, {'db': db, 'web': web})
+        self.assertEqual(failed, [])
+        results, failed = _match_inspected([web, db], ['db', 'web'])
+        self.assertEqual(results, {'db': db, 'web': web})
+
+    def test_id_prefix(self):
+        web = {'Id': 'db0123456789', 'Name': '/web'}
+        results, failed = _match_inspected([web], ['db01', 'db0123456789', 'gone'])
+        self.assertEqual(results, {'db01': web, 'db0123456789': web})
+        self.assertEqual(failed, [])
+
+    def test_ambiguous_id_prefix(self):
+        items = [{'Id': 'ab01', 'Name': '/x'}, {'Id': 'ab02', 'Name': '/y'}]
+        results, failed = _match_inspected(items, ['ab', 'x'])
+        self.assertEqual(results, {'x': items[0]})
+        self.assertEqual(failed, ['ab'])
+
+
+if __name__ == '__main__':
+    unittest.main()